@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+"""
+Validates the resample-free CFO estimation modes of the CFO Estimator against the
+default resampled path on recorded HDF5 captures (one transmitter per file):
+per-frame differences, per-device CFO spread and time per frame of each mode.
+
+Captures are brought to --sample-rate like the live flowgraph sees them. The
+native-rate mode needs a multiple of 1.25 MHz; the integer fast path only
+applies to integer multiples of 20 Msps and is skipped otherwise.
+
+Example:
+    mobrffi_cfo_validate.py captures/*.h5 --sample-rate 25e6 --report cfo.json
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+from gnuradio.mobrffi.cfo_estimator import cfo_estimator
+from gnuradio.mobrffi.offline import load_captures
+
+MODES = {
+    "resample": dict(estimationMode="RESAMPLE"),
+    "native": dict(estimationMode="NATIVE"),
+    "integer": dict(estimationMode="RESAMPLE", integerDecimation=True),
+}
+
+
+def estimate(iq, sample_rate, repeats, **kwargs):
+    """CFO of every frame in Hz, and the best-of-`repeats` time per frame in microseconds."""
+    block = cfo_estimator(vectorLength=iq.shape[1], sampleRate=sample_rate, metricsInterval=0, **kwargs)
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        cfo = block.extract_preamble_cfo(iq, fs_in=sample_rate)[2]
+        best = min(best, time.perf_counter() - t0)
+    return np.asarray(cfo, dtype=np.float64), best * 1e6 / iq.shape[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare resample-free CFO estimation with the resampled path on recorded captures.")
+    parser.add_argument("captures", nargs="+", help="HDF5 captures, one transmitter per file")
+    parser.add_argument("--vector-length", type=int, default=400, help="Preamble samples per frame at --sample-rate")
+    parser.add_argument("--capture-rate", type=float, default=20e6, help="Sample rate of the captures")
+    parser.add_argument("--sample-rate", type=float, default=25e6, help="Rate the CFO Estimator runs at")
+    parser.add_argument("--max-frames", type=int, default=None, help="Frames per capture")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--report", default=None, help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    iq, labels, names = load_captures(args.captures, max_frames=args.max_frames, vector_length=args.vector_length,
+                                      capture_rate=args.capture_rate, sample_rate=args.sample_rate)
+    print(f"Loaded {iq.shape[0]} frames from {len(names)} captures at {args.sample_rate/1e6:g} Msps")
+
+    modes = ["resample", "native"]
+    if np.isclose(args.sample_rate / 20e6, round(args.sample_rate / 20e6)) and round(args.sample_rate / 20e6) >= 2:
+        modes.append("integer")
+
+    cfo, us = {}, {}
+    for mode in modes:
+        try:
+            cfo[mode], us[mode] = estimate(iq, args.sample_rate, args.repeats, **MODES[mode])
+        except ValueError as e:
+            print(f"Skipping {mode}: {e}")
+
+    print()
+    print(f"{'mode':>10s}{'us/frame':>10s}{'speedup':>9s}{'|diff| p50':>12s}{'p95':>9s}{'max':>10s}{'device std':>12s}")
+    results = []
+    for mode in cfo:
+        diff = np.abs(cfo[mode] - cfo["resample"])
+        # Spread of each transmitter's CFO over its frames; a good estimator keeps it small
+        spread = float(np.median([np.std(cfo[mode][labels == i]) for i in range(len(names))]))
+        r = {
+            "mode": mode,
+            "us_per_frame": us[mode],
+            "speedup": us["resample"] / us[mode],
+            "diff_p50_hz": float(np.percentile(diff, 50)),
+            "diff_p95_hz": float(np.percentile(diff, 95)),
+            "diff_max_hz": float(diff.max()),
+            "device_std_hz": spread,
+        }
+        results.append(r)
+        print(f"{mode:>10s}{r['us_per_frame']:10.2f}{r['speedup']:8.1f}x{r['diff_p50_hz']:12.1f}{r['diff_p95_hz']:9.1f}"
+              f"{r['diff_max_hz']:10.1f}{r['device_std_hz']:12.1f}")
+
+    print()
+    print(f"{'capture':<40s}" + "".join(f"{m + ' kHz':>16s}" for m in cfo))
+    devices = []
+    for i, name in enumerate(names):
+        mean = {m: float(np.mean(cfo[m][labels == i])) for m in cfo}
+        devices.append({"capture": name, "frames": int(np.sum(labels == i)), "mean_cfo_hz": mean})
+        print(f"{name[-40:]:<40s}" + "".join(f"{mean[m]/1e3:16.2f}" for m in cfo))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({
+                "frames": int(iq.shape[0]),
+                "capture_rate": args.capture_rate,
+                "sample_rate": args.sample_rate,
+                "vector_length": args.vector_length,
+                "modes": results,
+                "devices": devices,
+            }, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
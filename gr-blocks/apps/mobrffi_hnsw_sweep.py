@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+"""
+Replays stored MobRFFI embeddings into fresh Chroma collections under a grid of
+HNSW parameters (M, construction ef, search ef) and reports insert throughput,
+query latency percentiles and re-ID decision agreement with exact search, to
+pick reid's hnswM / hnswConstructionEf / hnswSearchEf.
+
+Embeddings come from a reid gallery snapshot, an existing Chroma collection or
+an (N, D) .npy file. Queries are noisy re-observations of stored embeddings,
+plus stored embeddings held out of the collection to stand in for new devices.
+
+Example:
+    mobrffi_hnsw_sweep.py --snapshot ~/mobrffi_snapshot \\
+        --m 8 16 32 --construction-ef 64 100 200 --search-ef 10 32 64 100 200 \\
+        --report hnsw.json
+"""
+
+import sys
+import json
+import time
+import argparse
+import itertools
+import tempfile
+import numpy as np
+
+try:
+    import chromadb
+    from chromadb.config import Settings
+except Exception as e:
+    raise ImportError("chromadb is required: `pip install chromadb`")
+
+from gnuradio.mobrffi.gallery import EmbeddingGallery, l2_normalize, load_snapshot
+from gnuradio.mobrffi.persistence import hnsw_metadata
+
+
+def load_embeddings(args):
+    if args.snapshot:
+        snap = load_snapshot(args.snapshot)
+        if snap is None:
+            raise FileNotFoundError(f"No gallery snapshot found in {args.snapshot}")
+        return np.asarray(snap[0], dtype=np.float32)
+    if args.chroma_path:
+        collection = chromadb.PersistentClient(path=args.chroma_path).get_collection(args.collection)
+        pages = []
+        for offset in range(0, collection.count(), 4096):
+            pages.append(np.asarray(collection.get(limit=4096, offset=offset, include=["embeddings"])["embeddings"], dtype=np.float32))
+        return np.concatenate(pages)
+    return np.load(args.embeddings).astype(np.float32)
+
+
+def make_queries(stored, n, unknown, threshold, rng):
+    """Splits off held-out rows (unseen devices) and builds n queries; returns (gallery, queries)."""
+    order = rng.permutation(stored.shape[0])
+    n_unknown = int(round(unknown * n))
+    held_out, gallery = stored[order[:n_unknown]], stored[order[n_unknown:]]
+    # Re-observations with noise of about half the match threshold, in cosine distance
+    seen = gallery[rng.integers(0, gallery.shape[0], n - n_unknown)]
+    seen = seen + rng.standard_normal(seen.shape).astype(np.float32) * np.sqrt(threshold / stored.shape[1])
+    queries = l2_normalize(np.concatenate([seen, held_out]))
+    return gallery, queries[rng.permutation(queries.shape[0])]
+
+
+def decisions(rows, distances, threshold):
+    """The row a frame would be labelled with, or -1 if it would be enrolled as new."""
+    return np.where(distances <= threshold, rows, -1)
+
+
+def run_setting(client, gallery, queries, hnsw, args):
+    name = "sweep_{}_{}_{}".format(hnsw["hnsw:M"], hnsw["hnsw:construction_ef"], hnsw["hnsw:search_ef"])
+    try:
+        client.delete_collection(name)
+    except Exception:
+        pass
+    collection = client.create_collection(name=name, metadata=hnsw)
+
+    # Insert in the batches reid's write-behind writer would use
+    t0 = time.perf_counter()
+    for start in range(0, gallery.shape[0], args.insert_batch):
+        stop = min(start + args.insert_batch, gallery.shape[0])
+        collection.add(
+            ids=[str(i) for i in range(start, stop)],
+            embeddings=gallery[start:stop].tolist(),
+            metadatas=[{"label": i} for i in range(start, stop)],
+        )
+    insert_s = time.perf_counter() - t0
+
+    latencies, rows, distances = [], [], []
+    for start in range(0, queries.shape[0], args.query_batch):
+        batch = queries[start:start + args.query_batch]
+        t0 = time.perf_counter()
+        res = collection.query(query_embeddings=batch.tolist(), n_results=1, include=["distances"])
+        latencies.append(time.perf_counter() - t0)
+        rows.extend(int(ids[0]) if ids else -1 for ids in res["ids"])
+        distances.extend(d[0] if d else np.inf for d in res["distances"])
+
+    client.delete_collection(name)
+    latencies = np.array(latencies) * 1e3
+    return {
+        "m": hnsw["hnsw:M"],
+        "construction_ef": hnsw["hnsw:construction_ef"],
+        "search_ef": hnsw["hnsw:search_ef"],
+        "inserts_per_s": gallery.shape[0] / insert_s,
+        "query_p50_ms": float(np.percentile(latencies, 50)),
+        "query_p99_ms": float(np.percentile(latencies, 99)),
+    }, np.array(rows, dtype=np.int64), np.array(distances, dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep Chroma HNSW parameters for reid: insert throughput, query p99 and agreement with exact search.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--snapshot", help="reid gallery snapshot directory (snapshotPath)")
+    source.add_argument("--chroma-path", help="Chroma directory holding a reid collection")
+    source.add_argument("--embeddings", help="(N, D) embeddings as .npy")
+    parser.add_argument("--collection", default="mobrffi", help="Collection name with --chroma-path")
+    parser.add_argument("--m", type=int, nargs="+", default=[8, 16, 32], help="HNSW graph degrees")
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=[64, 100, 200])
+    parser.add_argument("--search-ef", type=int, nargs="+", default=[10, 32, 64, 100, 200])
+    parser.add_argument("--queries", type=int, default=2000, help="Queries per setting")
+    parser.add_argument("--unknown", type=float, default=0.2, help="Fraction of queries from held-out (unseen) devices")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Cosine distance threshold of the re-ID decision")
+    parser.add_argument("--insert-batch", type=int, default=256, help="Records per add(), like persistBatchSize")
+    parser.add_argument("--query-batch", type=int, default=1, help="Queries per query() call; latency percentiles are per call")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", default=None, help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    stored = l2_normalize(load_embeddings(args))
+    gallery, queries = make_queries(stored, min(args.queries, stored.shape[0]), args.unknown, args.threshold, rng)
+    print(f"Replaying {gallery.shape[0]} embeddings of {gallery.shape[1]} values; {queries.shape[0]} queries")
+
+    exact = EmbeddingGallery(gallery.shape[1])
+    exact.attach(gallery, np.arange(gallery.shape[0], dtype=np.int64))
+    exact_rows, exact_d = exact.search(queries, k=1)
+    exact_decisions = decisions(exact_rows[:, 0], exact_d[:, 0], args.threshold)
+
+    print()
+    print(f"{'M':>4s}{'c_ef':>6s}{'s_ef':>6s}{'inserts/s':>12s}{'p50 ms':>10s}{'p99 ms':>10s}{'recall@1':>10s}{'agreement':>11s}")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        client = chromadb.PersistentClient(path=tmp, settings=Settings(allow_reset=True))
+        for m, c_ef, s_ef in itertools.product(args.m, args.construction_ef, args.search_ef):
+            r, rows, distances = run_setting(client, gallery, queries, hnsw_metadata(m, c_ef, s_ef), args)
+            r["recall_at_1"] = float(np.mean(rows == exact_rows[:, 0]))
+            r["decision_agreement"] = float(np.mean(decisions(rows, distances, args.threshold) == exact_decisions))
+            results.append(r)
+            print(f"{m:4d}{c_ef:6d}{s_ef:6d}{r['inserts_per_s']:12.0f}{r['query_p50_ms']:10.3f}{r['query_p99_ms']:10.3f}"
+                  f"{r['recall_at_1']:10.4f}{r['decision_agreement']:11.4f}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({
+                "gallery_size": int(gallery.shape[0]),
+                "dim": int(gallery.shape[1]),
+                "queries": int(queries.shape[0]),
+                "threshold": args.threshold,
+                "insert_batch": args.insert_batch,
+                "query_batch": args.query_batch,
+                "new_device_fraction": float(np.mean(exact_decisions < 0)),
+                "settings": results,
+            }, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
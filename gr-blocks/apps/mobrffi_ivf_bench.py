@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+"""
+Benchmarks the IVF gallery index of reid against exact search: recall@1 and
+re-ID decision agreement versus query latency, for several gallery sizes and
+numbers of probed cells. Galleries are synthetic clustered embeddings unless
+real ones are given with --embeddings.
+
+Example:
+    mobrffi_ivf_bench.py --sizes 1000 10000 100000 1000000 \\
+        --nprobe 1 2 4 8 16 32 --plot ivf.png --report ivf.json
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+from gnuradio.mobrffi.gallery import EmbeddingGallery, IVFGallery, l2_normalize
+
+
+def synthetic_gallery(n, dim, rng, spread=0.35):
+    """n device embeddings around sqrt(n) family centers, so near neighbours are close."""
+    families = l2_normalize(rng.standard_normal((max(1, int(np.sqrt(n))), dim)).astype(np.float32))
+    emb = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, 65536):
+        stop = min(start + 65536, n)
+        noise = rng.standard_normal((stop - start, dim)).astype(np.float32) * (spread / np.sqrt(dim))
+        emb[start:stop] = l2_normalize(families[rng.integers(0, families.shape[0], stop - start)] + noise)
+    return emb
+
+
+def make_queries(gallery, n, threshold, rng, unknown=0.2):
+    """Noisy re-observations of random gallery entries, plus a fraction of unseen devices."""
+    dim = gallery.shape[1]
+    rows = rng.integers(0, gallery.shape[0], n)
+    # Noise of about half the match threshold, in cosine distance
+    sigma = np.sqrt(threshold / dim)
+    queries = gallery[rows] + rng.standard_normal((n, dim)).astype(np.float32) * sigma
+    new = rng.random(n) < unknown
+    queries[new] = rng.standard_normal((int(new.sum()), dim)).astype(np.float32)
+    return l2_normalize(queries)
+
+
+def timed_search(gallery, queries, batch_size, repeats):
+    """Best-of-`repeats` search time in milliseconds per query, and the results."""
+    best = float("inf")
+    for _ in range(repeats):
+        rows, distances = [], []
+        t0 = time.perf_counter()
+        for start in range(0, queries.shape[0], batch_size):
+            r, d = gallery.search(queries[start:start + batch_size], k=1)
+            rows.append(r[:, 0])
+            distances.append(d[:, 0])
+        best = min(best, time.perf_counter() - t0)
+    return best * 1e3 / queries.shape[0], np.concatenate(rows), np.concatenate(distances)
+
+
+def decisions(rows, distances, threshold):
+    """The row a frame would be labelled with, or -1 if it would be enrolled as new."""
+    return np.where(distances <= threshold, rows, -1)
+
+
+def plot(results, path):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except Exception as e:
+        print(f"matplotlib is not available, skipping the plot: {e}")
+        return
+
+    fig, axes = plt.subplots(1, 2, figsize=(12, 4.5), sharex=True)
+    for size in results:
+        latency = [r["latency_ms"] for r in size["ivf"]]
+        for ax, key in zip(axes, ("recall_at_1", "decision_agreement")):
+            line, = ax.plot(latency, [r[key] for r in size["ivf"]], marker="o", label=f"N = {size['size']:,}")
+            ax.axvline(size["exact_latency_ms"], color=line.get_color(), linestyle=":", linewidth=1)
+            for r in size["ivf"]:
+                ax.annotate(str(r["nprobe"]), (r["latency_ms"], r[key]), fontsize=7, xytext=(3, -8), textcoords="offset points")
+    for ax, title in zip(axes, ("Recall@1", "Re-ID decision agreement")):
+        ax.set_xscale("log")
+        ax.set_xlabel("Latency per query (ms); dotted = exact search")
+        ax.set_title(title)
+        ax.grid(True, which="both", alpha=0.3)
+    axes[0].legend()
+    fig.tight_layout()
+    fig.savefig(path, dpi=150)
+    print(f"Wrote plot: {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall and re-ID agreement versus latency of reid's IVF index against exact search.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], help="Gallery sizes")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="IVF cells probed per query")
+    parser.add_argument("--nlist", type=int, default=0, help="IVF cells (0 = 4 * sqrt(N), as in reid)")
+    parser.add_argument("--dim", type=int, default=256, help="Dimension of the synthetic embeddings")
+    parser.add_argument("--embeddings", default=None, help="Use these (N, D) embeddings (.npy) as the gallery instead")
+    parser.add_argument("--queries", type=int, default=2000, help="Queries per gallery size")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Cosine distance threshold of the re-ID decision")
+    parser.add_argument("--batch-size", type=int, default=256, help="Queries per search call, as reid batches frames")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--plot", default=None, help="Write the recall/agreement vs. latency plot to this path")
+    parser.add_argument("--report", default=None, help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    source = None
+    if args.embeddings:
+        source = l2_normalize(np.load(args.embeddings, mmap_mode="r").astype(np.float32))
+        print(f"Loaded {source.shape[0]} embeddings of {source.shape[1]} values: {args.embeddings}")
+
+    results = []
+    for n in sorted(args.sizes):
+        if source is not None and n > source.shape[0]:
+            print(f"Skipping N = {n}: only {source.shape[0]} embeddings available")
+            continue
+        gallery = source[:n] if source is not None else synthetic_gallery(n, args.dim, rng)
+        queries = make_queries(gallery, args.queries, args.threshold, rng)
+        labels = np.arange(n, dtype=np.int64)
+
+        exact = EmbeddingGallery(gallery.shape[1])
+        exact.attach(gallery, labels)
+        exact_ms, exact_rows, exact_d = timed_search(exact, queries, args.batch_size, args.repeats)
+        exact_decisions = decisions(exact_rows, exact_d, args.threshold)
+
+        ivf = IVFGallery(gallery.shape[1], nlist=args.nlist, train_size=min(n, 4096))
+        t0 = time.perf_counter()
+        ivf.add(gallery, labels)
+        ivf.wait_ready()
+        build_s = time.perf_counter() - t0
+        print(f"\nN = {n:,}: {ivf.cells} cells, built in {build_s:.1f} s; exact search {exact_ms:.4f} ms/query")
+        print(f"{'nprobe':>8s}{'recall@1':>12s}{'agreement':>12s}{'ms/query':>12s}{'speedup':>10s}")
+
+        rows = []
+        for nprobe in sorted(args.nprobe):
+            ivf.nprobe = nprobe
+            ms, ivf_rows, ivf_d = timed_search(ivf, queries, args.batch_size, args.repeats)
+            r = {
+                "nprobe": nprobe,
+                "recall_at_1": float(np.mean(ivf_rows == exact_rows)),
+                "decision_agreement": float(np.mean(decisions(ivf_rows, ivf_d, args.threshold) == exact_decisions)),
+                "latency_ms": ms,
+                "speedup": exact_ms / ms,
+            }
+            rows.append(r)
+            print(f"{nprobe:8d}{r['recall_at_1']:12.4f}{r['decision_agreement']:12.4f}{ms:12.4f}{r['speedup']:9.1f}x")
+
+        results.append({
+            "size": n,
+            "dim": int(gallery.shape[1]),
+            "nlist": ivf.cells,
+            "build_s": build_s,
+            "exact_latency_ms": exact_ms,
+            "new_device_fraction": float(np.mean(exact_decisions < 0)),
+            "ivf": rows,
+        })
+
+    if args.plot and results:
+        plot(results, args.plot)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({
+                "source": args.embeddings or "synthetic",
+                "queries": args.queries,
+                "threshold": args.threshold,
+                "batch_size": args.batch_size,
+                "results": results,
+            }, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+"""
+Fits a PCA (optionally whitening) projection on MobRFFI embeddings computed from
+host-receiver HDF5 captures, and reports re-ID accuracy against the projected
+dimension so that reid can search and store smaller embeddings.
+
+Example:
+    mobrffi_pca.py model.onnx projection.npz --dim 96 \\
+        --fit ~/captures/alfa_01.h5 ~/captures/alfa_02.h5 \\
+        --holdout ~/holdout/alfa_01.h5 ~/holdout/alfa_02.h5
+"""
+
+import sys
+import json
+import argparse
+
+try:
+    import onnxruntime as ort
+except Exception as e:
+    raise ImportError("onnxruntime is required: `pip install onnxruntime`")
+
+from gnuradio.mobrffi import offline
+from gnuradio.mobrffi.projection import fit_pca
+
+
+def embed(session, paths, max_frames, load_kwargs, args):
+    iq, labels, names = offline.load_captures(paths, max_frames=max_frames, **load_kwargs)
+    specs = offline.compute_spectrograms(iq, args.spec_width)
+    return offline.compute_embeddings(session, specs, batch_size=args.batch_size), labels, names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit a PCA projection for MobRFFI embeddings and report re-ID accuracy per dimension.")
+    parser.add_argument("model", help="ONNX fingerprint model")
+    parser.add_argument("output", help="Path of the projection (.npz) for reid's projectionPath")
+    parser.add_argument("--fit", nargs="+", required=True, help="HDF5 captures the projection is fitted on")
+    parser.add_argument("--holdout", nargs="+", required=True, help="HDF5 captures (one device per file) for the report")
+    parser.add_argument("--dim", type=int, default=128, help="Dimension of the saved projection")
+    parser.add_argument("--sweep", type=int, nargs="+", default=[16, 32, 48, 64, 96, 128, 192, 256], help="Dimensions to report accuracy for")
+    parser.add_argument("--whiten", action="store_true", help="Scale every component to unit variance")
+    parser.add_argument("--fit-frames", type=int, default=500, help="Frames per fitting capture")
+    parser.add_argument("--holdout-frames", type=int, default=None, help="Frames per held-out capture (default: all)")
+    parser.add_argument("--enroll", type=int, default=20, help="Frames per device used to build the re-ID gallery")
+    parser.add_argument("--vector-length", type=int, default=400)
+    parser.add_argument("--spec-width", type=int, default=80)
+    parser.add_argument("--capture-rate", type=float, default=20e6, help="Sample rate of the HDF5 captures (Hz)")
+    parser.add_argument("--sample-rate", type=float, default=25e6, help="Sample rate the model was trained at (Hz)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--report", default=None, help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    load_kwargs = dict(vector_length=args.vector_length, capture_rate=args.capture_rate, sample_rate=args.sample_rate)
+    session = ort.InferenceSession(args.model, providers=["CPUExecutionProvider"])
+
+    fit_emb, _, _ = embed(session, args.fit, args.fit_frames, load_kwargs, args)
+    holdout_emb, labels, names = embed(session, args.holdout, args.holdout_frames, load_kwargs, args)
+    full_dim = fit_emb.shape[1]
+    print(f"Fitting on {fit_emb.shape[0]} embeddings of {full_dim} values from {len(args.fit)} captures...")
+
+    dims = sorted({d for d in args.sweep + [args.dim] if d <= min(full_dim, fit_emb.shape[0])})
+    projection = fit_pca(fit_emb, max(dims), whiten=args.whiten)
+
+    full_accuracy, _ = offline.reid_accuracy(holdout_emb, labels, n_enroll=args.enroll)
+    rows = []
+    for d in dims:
+        p = projection.truncate(d)
+        accuracy, _ = offline.reid_accuracy(p.apply(holdout_emb), labels, n_enroll=args.enroll)
+        rows.append({"dim": d, "accuracy": accuracy, "explained_variance": float(p.explained.sum()), "memory_ratio": full_dim / d})
+
+    print()
+    print(f"{'dim':>6s}{'re-ID accuracy':>16s}{'explained var':>16s}{'smaller by':>12s}")
+    for r in rows:
+        print(f"{r['dim']:6d}{r['accuracy']:16.4f}{r['explained_variance']:16.4f}{r['memory_ratio']:11.1f}x")
+    print(f"{full_dim:6d}{full_accuracy:16.4f}{1.0:16.4f}{1.0:11.1f}x  (no projection)")
+
+    saved = projection.truncate(args.dim)
+    saved.save(args.output)
+    print(f"Wrote {saved.dim}-dimensional {'whitened ' if args.whiten else ''}projection: {args.output}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({
+                "holdout_devices": len(names),
+                "holdout_frames": int(holdout_emb.shape[0]),
+                "full_dim": full_dim,
+                "full_accuracy": full_accuracy,
+                "whiten": args.whiten,
+                "dims": rows,
+            }, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
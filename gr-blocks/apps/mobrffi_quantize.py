@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+"""
+Converts a MobRFFI fingerprint model to a static INT8 (or FP16) ONNX model for
+CPU-only receivers, calibrated on host-receiver HDF5 captures, and reports
+embedding drift, re-ID accuracy and batch latency next to the FP32 model.
+
+Example:
+    mobrffi_quantize.py model.onnx model_int8.onnx \\
+        --calib ~/captures/alfa_01.h5 ~/captures/alfa_02.h5 \\
+        --holdout ~/holdout/alfa_01.h5 ~/holdout/alfa_02.h5
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import numpy as np
+
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+except Exception as e:
+    raise ImportError("onnxruntime and onnx are required: `pip install onnxruntime onnx`")
+
+from gnuradio.mobrffi import offline
+
+
+class _SpectrogramReader(CalibrationDataReader):
+    """Feeds calibration spectrograms to onnxruntime's static quantizer."""
+    def __init__(self, input_name, specs, batch_size):
+        self._input_name = input_name
+        self._specs = specs
+        self._batch_size = batch_size
+        self._start = 0
+
+    def get_next(self):
+        if self._start >= self._specs.shape[0]:
+            return None
+        batch = self._specs[self._start:self._start + self._batch_size]
+        self._start += self._batch_size
+        return {self._input_name: batch}
+
+    def rewind(self):
+        self._start = 0
+
+
+def quantize_int8(model_path, output_path, calib_specs, batch_size, per_channel):
+    session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    reader = _SpectrogramReader(session.get_inputs()[0].name, calib_specs, offline.session_batch_size(session, batch_size))
+
+    # Shape inference + graph cleanup first, as recommended for static quantization
+    with tempfile.TemporaryDirectory() as tmp:
+        prepped = os.path.join(tmp, "prepped.onnx")
+        quant_pre_process(model_path, prepped)
+        quantize_static(
+            prepped, output_path, reader,
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=per_channel,
+        )
+
+
+def convert_fp16(model_path, output_path):
+    try:
+        import onnx
+        from onnxconverter_common import float16
+    except Exception as e:
+        raise ImportError("FP16 conversion requires onnx and onnxconverter-common: `pip install onnx onnxconverter-common`")
+
+    # Keep float32 I/O so get_fingerprint can feed the model unchanged
+    model = float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+    onnx.save(model, output_path)
+
+
+def evaluate(model_path, specs, labels, args):
+    session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    embeddings = offline.compute_embeddings(session, specs, batch_size=args.batch_size)
+    accuracy, predictions = offline.reid_accuracy(embeddings, labels, n_enroll=args.enroll)
+    p50, p95 = offline.batch_latency_ms(session, specs, batch_size=args.batch_size, repeats=args.repeats)
+    return {"embeddings": embeddings, "predictions": predictions, "accuracy": accuracy, "latency_p50_ms": p50, "latency_p95_ms": p95}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize a MobRFFI fingerprint model and compare it against FP32.")
+    parser.add_argument("model", help="FP32 ONNX model")
+    parser.add_argument("output", help="Path of the quantized ONNX model")
+    parser.add_argument("--mode", choices=["int8", "fp16"], default="int8")
+    parser.add_argument("--calib", nargs="+", default=[], help="HDF5 captures used for INT8 calibration")
+    parser.add_argument("--holdout", nargs="+", required=True, help="HDF5 captures (one device per file) for the report")
+    parser.add_argument("--calib-frames", type=int, default=200, help="Frames per calibration capture")
+    parser.add_argument("--holdout-frames", type=int, default=None, help="Frames per held-out capture (default: all)")
+    parser.add_argument("--enroll", type=int, default=20, help="Frames per device used to build the re-ID gallery")
+    parser.add_argument("--vector-length", type=int, default=400)
+    parser.add_argument("--spec-width", type=int, default=80)
+    parser.add_argument("--capture-rate", type=float, default=20e6, help="Sample rate of the HDF5 captures (Hz)")
+    parser.add_argument("--sample-rate", type=float, default=25e6, help="Sample rate the model was trained at (Hz)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=50, help="Timed runs per latency measurement")
+    parser.add_argument("--per-channel", action="store_true", help="Per-channel INT8 weight quantization")
+    parser.add_argument("--report", default=None, help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    load_kwargs = dict(vector_length=args.vector_length, capture_rate=args.capture_rate, sample_rate=args.sample_rate)
+
+    if args.mode == "int8":
+        if not args.calib:
+            parser.error("--calib is required for INT8 quantization")
+        calib_iq, _, _ = offline.load_captures(args.calib, max_frames=args.calib_frames, **load_kwargs)
+        calib_specs = offline.compute_spectrograms(calib_iq, args.spec_width)
+        print(f"Calibrating on {calib_specs.shape[0]} frames from {len(args.calib)} captures...")
+        quantize_int8(args.model, args.output, calib_specs, args.batch_size, args.per_channel)
+    else:
+        convert_fp16(args.model, args.output)
+    print(f"Wrote {args.mode.upper()} model: {args.output}")
+
+    holdout_iq, labels, names = offline.load_captures(args.holdout, max_frames=args.holdout_frames, **load_kwargs)
+    specs = offline.compute_spectrograms(holdout_iq, args.spec_width)
+
+    ref = evaluate(args.model, specs, labels, args)
+    quant = evaluate(args.output, specs, labels, args)
+
+    # Embedding drift as cosine distance between FP32 and quantized embeddings of the same frame
+    cos = np.sum(offline.l2_normalize(ref["embeddings"]) * offline.l2_normalize(quant["embeddings"]), axis=1)
+    drift = 1.0 - cos
+    agreement = float(np.mean(ref["predictions"] == quant["predictions"])) if ref["predictions"].size else float("nan")
+
+    report = {
+        "mode": args.mode,
+        "holdout_frames": int(specs.shape[0]),
+        "holdout_devices": len(names),
+        "batch_size": args.batch_size,
+        "cosine_drift_mean": float(drift.mean()),
+        "cosine_drift_p99": float(np.percentile(drift, 99)),
+        "cosine_drift_max": float(drift.max()),
+        "decision_agreement": agreement,
+        "fp32": {k: ref[k] for k in ("accuracy", "latency_p50_ms", "latency_p95_ms")},
+        args.mode: {k: quant[k] for k in ("accuracy", "latency_p50_ms", "latency_p95_ms")},
+    }
+
+    print()
+    print(f"{'':24s}{'FP32':>12s}{args.mode.upper():>12s}")
+    print(f"{'re-ID accuracy':24s}{ref['accuracy']:12.4f}{quant['accuracy']:12.4f}")
+    print(f"{'batch latency p50 (ms)':24s}{ref['latency_p50_ms']:12.3f}{quant['latency_p50_ms']:12.3f}")
+    print(f"{'batch latency p95 (ms)':24s}{ref['latency_p95_ms']:12.3f}{quant['latency_p95_ms']:12.3f}")
+    print(f"Speedup (p50): {ref['latency_p50_ms'] / quant['latency_p50_ms']:.2f}x")
+    print(f"Cosine drift: mean {report['cosine_drift_mean']:.5f}, p99 {report['cosine_drift_p99']:.5f}, max {report['cosine_drift_max']:.5f}")
+    print(f"Decision agreement with FP32: {agreement:.4f}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,20 @@
 import logging
+import pmt
 import numpy as np
 from scipy import signal
 from fractions import Fraction
 from gnuradio import gr
+from .metrics import BlockMetrics
 
 _EPS = 1e-12
+_FS_REF = 20e6  # 802.11 preamble indexing below assumes 20 Msps
+
+def _native_scale(fs):
+    """fs / 20 Msps; raises ValueError unless the 16-sample L-STF lag is a whole number of samples at fs."""
+    scale = fs / _FS_REF
+    if not np.isclose(16 * scale, round(16 * scale)):
+        raise ValueError(f"NATIVE estimation needs a sample rate at which the preamble lags are whole samples (a multiple of 1.25 MHz), got {fs/1e6:g} MHz.")
+    return scale
 
 class cfo_estimator(gr.sync_block):
     """
@@ -13,7 +23,11 @@ class cfo_estimator(gr.sync_block):
     def __init__(self,
                  vectorLength=400,
                  sampleRate=25e6,
-                 lag=16):
+                 lag=16,
+                 estimationMode='RESAMPLE',
+                 integerDecimation=False,
+                 metricsInterval=5.0,
+                 metricsFile=''):
         gr.sync_block.__init__(
             self,
             name="MobRFFI CFO Estimator",
@@ -23,6 +37,8 @@ class cfo_estimator(gr.sync_block):
         self.vectorLength = int(vectorLength)
         self.fs = float(sampleRate)
         self.lag = int(lag)
+        self.estimationMode = str(estimationMode).upper().strip()
+        self.integerDecimation = bool(integerDecimation)
 
         # Logging
         self._log = logging.getLogger("mobrffi.cfo")
@@ -36,86 +52,132 @@ class cfo_estimator(gr.sync_block):
         if self.vectorLength < 320: raise ValueError("vectorLength must be at least 320 IQ samples long.")
         if self.fs <= 0: raise ValueError("sampleRate must be a positive integer.")
         if self.lag <= 0: raise ValueError("lag must be a positive integer.")
+        if self.estimationMode not in ("RESAMPLE", "NATIVE"): raise ValueError("estimationMode must be either RESAMPLE or NATIVE.")
+        if self.estimationMode == "NATIVE": _native_scale(self.fs)  # raises off the 1.25 MHz grid
+
+        # Resampling ratio to 20 Msps, the rate the estimates run at and the phase ramp
+        # 2*pi*n/fs of the coarse derotation over the L-STF and L-LTF at that rate
+        frac = Fraction(_FS_REF / self.fs).limit_denominator()
+        self._up, self._down = frac.numerator, frac.denominator
+        self._fs_est = self.fs if self.estimationMode == "NATIVE" else _FS_REF
+        self._ramp = 2 * np.pi * np.arange(int(round(320 * self._fs_est / _FS_REF)), dtype=np.float64) / self._fs_est
+        if self.estimationMode == "NATIVE":
+            self._log.info(f"Estimating CFO at the native {self.fs/1e6:g} Msps, without resampling.")
+        elif self.integerDecimation and self._decimation(self.fs):
+            self._log.info(f"Estimating CFO after decimating by {self._decimation(self.fs)}, without resampling.")
+
+        # Instrumentation, published on the "metrics" message port every metricsInterval seconds
+        self._metrics = BlockMetrics("cfo_estimator", self.unique_id(), interval=metricsInterval, path=metricsFile, log=self._log)
+        self._metrics_port = pmt.intern("metrics")
+        self.message_port_register_out(self._metrics_port)
 
     def work(self, input_items, output_items):
         in_mat = input_items[0]
         out_vec = output_items[0]
 
         if in_mat.shape[1] != self.vectorLength:
+            self._metrics.count("errors")
             self._log.error(f"Incorrect input vector: received {in_mat.shape[1]}, expected {self.vectorLength}.")
             return 0
         
-        produced = 0
-        for i in range(in_mat.shape[0]):
-            iq = in_mat[i].astype(np.complex64, copy=False).ravel()
-
-            _, _, cfo_total_hz = self.extract_preamble_cfo(iq, fs_in=self.fs)
+        produced = in_mat.shape[0]
+        with self._metrics.time("cfo"):
+            # The whole block at once: one resampling call and row-wise correlations
+            _, _, cfo_total_hz = self.extract_preamble_cfo(in_mat.astype(np.complex64, copy=False), fs_in=self.fs)
 
-            # self._log.info(f"IQ received. CFO: {cfo_total_hz} Hz")
+        out_vec[:produced] = cfo_total_hz.astype(np.float32)
 
-            out_vec[i] = np.float32(cfo_total_hz)
-            produced += 1
+        self._metrics.count("frames", produced)
+        self._metrics.maybe_publish(self, self._metrics_port)
 
         return produced
 
-    def _cfo_estimate_hz(self, x: np.ndarray, D: int, fs: float) -> float:
+    def _decimation(self, fs):
+        """m if fs is m >= 2 times 20 Msps, else 0."""
+        m = int(round(fs / _FS_REF))
+        return m if m >= 2 and np.isclose(fs, m * _FS_REF) else 0
+
+    def _cfo_estimate_hz(self, x: np.ndarray, D: int, fs: float) -> np.ndarray:
         """
-        CFO from delayed self-correlation with lag D.
+        CFO from delayed self-correlation with lag D, of every row of x (last axis).
         Returns frequency in Hz.
         """
-        r = np.vdot(x[:-D], x[D:])
-        return float(np.angle(r) * fs / (2*np.pi*D))
+        r = np.einsum("...i,...i->...", np.conj(x[..., :-D]), x[..., D:])
+        return np.angle(r) * fs / (2*np.pi*D)
 
-    def coarse_cfo_estimate(self, stf: np.ndarray, fs: float) -> float:
+    def coarse_cfo_estimate(self, stf: np.ndarray, fs: float, scale: float=1.0) -> float:
         """
         Coarse CFO from L-STF (10 short symbols of 16 samples @ 20 Msps).
+        At other rates, scale = fs / 20 Msps stretches the lag and offset (20 and 15 @ 25 Msps).
         """
         fft_len = 64
-        M = fft_len // 4
-        GI = fft_len // 4
+        M = int(round(fft_len // 4 * scale))
+        GI = fft_len // 4 * scale
         offset = int(round(0.75 * GI))
-        use_len = min(M*9, len(stf) - offset)
-        use = stf[offset:offset + use_len]
+        use_len = min(M*9, stf.shape[-1] - offset)
+        use = stf[..., offset:offset + use_len]
         return self._cfo_estimate_hz(use, M, fs)
 
-    def fine_cfo_estimate(self, ltf: np.ndarray, fs: float) -> float:
+    def fine_cfo_estimate(self, ltf: np.ndarray, fs: float, scale: float=1.0) -> float:
         """
         Fine CFO from L-LTF (2 long symbols of 64 samples @ 20 Msps).
+        At other rates, scale = fs / 20 Msps stretches the lag and offset (80 and 30 @ 25 Msps).
         """
         fft_len = 64
-        M = fft_len
-        GI = fft_len // 2
+        M = int(round(fft_len * scale))
+        GI = fft_len // 2 * scale
         offset = int(round(0.75 * GI))
-        use_len = min(2*M, len(ltf) - offset)
-        use = ltf[offset:offset + use_len]
+        use_len = min(2*M, ltf.shape[-1] - offset)
+        use = ltf[..., offset:offset + use_len]
         return self._cfo_estimate_hz(use, M, fs)
 
     def extract_preamble_cfo(self, preamble: np.ndarray, fs_in: float, show: bool=False):
         """
-        Estimate coarse+fine CFO (Hz) from a preamble captured at fs_in.
-        Internally resamples to 20 Msps for standard 802.11 preamble indexing.
-        Returns (coarse_hz, fine_hz, total_hz).
+        Estimate coarse+fine CFO (Hz) from a preamble captured at fs_in, or from every
+        row of an (N, samples) block of preambles.
+        By default resamples to 20 Msps for standard 802.11 preamble indexing. In NATIVE
+        mode the preamble is used at fs_in with the indexing scaled to that rate, which
+        must be a multiple of 1.25 MHz (ValueError otherwise). With integerDecimation a
+        rate of m * 20 Msps is brought down by averaging m samples.
+        Returns (coarse_hz, fine_hz, total_hz): floats for one preamble, (N,) arrays
+        for a block.
         """
-        fs_ref = 20e6
-        # Resample to 20 Msps only for estimation; CFO result is in Hz
-        if not np.isclose(fs_in, fs_ref):
-            frac = Fraction(fs_ref / fs_in).limit_denominator()
-            pre  = signal.resample_poly(preamble, frac.numerator, frac.denominator)
-        else:
+        fs = fs_ref = _FS_REF
+        scale = 1.0
+        m = self._decimation(fs_in)
+        if np.isclose(fs_in, fs_ref):
             pre = preamble
+        elif self.estimationMode == "NATIVE":
+            # No resampling: lags, offsets and segment lengths are stretched to fs_in instead
+            pre, fs, scale = preamble, fs_in, _native_scale(fs_in)
+        elif self.integerDecimation and m:
+            # Boxcar average then keep every m-th sample; its constant complex gain on
+            # the CFO tone cancels in the lagged correlations
+            n = preamble.shape[-1] - preamble.shape[-1] % m
+            pre = preamble[..., :n].reshape(*preamble.shape[:-1], n // m, m).mean(axis=-1)
+        else:
+            # Resample to 20 Msps only for estimation; CFO result is in Hz
+            if np.isclose(fs_in, self.fs):
+                up, down = self._up, self._down
+            else:
+                frac = Fraction(fs_ref / fs_in).limit_denominator()
+                up, down = frac.numerator, frac.denominator
+            pre = signal.resample_poly(preamble, up, down, axis=-1)
 
         # L-STF is first 160 samples; L-LTF is next 160 (at 20 Msps)
-        stf = pre[:160]
-        cfo_coarse = self.coarse_cfo_estimate(stf, fs_ref)
-
-        # Coarse derotation before fine estimate
-        n = np.arange(len(pre), dtype=np.float64)
-        pre_corr = pre * np.exp(-1j * 2*np.pi * cfo_coarse * n / fs_ref)
+        n_stf = int(round(160 * scale))
+        stf = pre[..., :n_stf]
+        cfo_coarse = self.coarse_cfo_estimate(stf, fs, scale)
 
-        ltf = pre_corr[160:320]
-        cfo_fine = self.fine_cfo_estimate(ltf, fs_ref)
+        # Coarse derotation of the L-LTF before the fine estimate, one phasor row per preamble
+        ltf = pre[..., n_stf:2 * n_stf]
+        ramp = self._ramp if np.isclose(fs, self._fs_est) else 2 * np.pi * np.arange(2 * n_stf, dtype=np.float64) / fs
+        ltf = ltf * np.exp(-1j * np.multiply.outer(cfo_coarse, ramp[n_stf:n_stf + ltf.shape[-1]]))
+        cfo_fine = self.fine_cfo_estimate(ltf, fs, scale)
 
         total = cfo_coarse + cfo_fine
-        if show:
-            self._log.info(f"CFO coarse: {cfo_coarse/1e3:.2f} kHz, fine: {cfo_fine/1e3:.2f} kHz, total: {total/1e3:.2f} kHz")
-        return cfo_coarse, cfo_fine, total
\ No newline at end of file
+        if np.ndim(total) == 0:
+            cfo_coarse, cfo_fine, total = float(cfo_coarse), float(cfo_fine), float(total)
+            if show:
+                self._log.info(f"CFO coarse: {cfo_coarse/1e3:.2f} kHz, fine: {cfo_fine/1e3:.2f} kHz, total: {total/1e3:.2f} kHz")
+        return cfo_coarse, cfo_fine, total
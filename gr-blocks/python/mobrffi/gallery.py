@@ -0,0 +1,729 @@
+"""
+In-memory embedding galleries used by the reid block as its query path: plain
+float32, compressed with full-precision rows on disk, or indexed by an IVF.
+"""
+import os
+import re
+import json
+import bisect
+import tempfile
+import numpy as np
+from concurrent import futures
+
+_EPS = 1e-12
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_FILE = re.compile(r"(?:embeddings|labels)\.(\d+)\.npy")
+
+def l2_normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), _EPS)
+
+class EmbeddingGallery():
+    """
+    Contiguous, L2-normalized float32 embedding matrix with one label per row.
+    Rows are appended to a buffer that doubles when full, and a batch of queries
+    is answered with one matrix multiply.
+    """
+    def __init__(self, dim, capacity=1024):
+        self.dim = int(dim)
+        self._emb = np.empty((max(1, int(capacity)), self.dim), dtype=np.float32)
+        self._labels = np.empty(self._emb.shape[0], dtype=np.int64)
+        self._n = 0
+        self._row_index = None
+        self._label_order = None
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def embeddings(self):
+        return self._emb[:self._n]
+
+    @property
+    def labels(self):
+        return self._labels[:self._n]
+
+    def row_labels(self, rows):
+        """Labels of the given rows; -1 where the row is -1."""
+        rows = np.asarray(rows)
+        return np.where(rows >= 0, self._labels[np.maximum(rows, 0)], -1)
+
+    def attach(self, embeddings, labels):
+        """
+        Uses already L2-normalized float32 `embeddings` (e.g. a read-only memory map) as
+        the gallery without copying; they are copied into a writable buffer on the first
+        add(). Other dtypes, such as a float16 snapshot, are converted up front.
+        """
+        if embeddings.dtype != np.float32:
+            embeddings = embeddings.astype(np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[1] != self.dim:
+            raise ValueError(f"Gallery embeddings must be (N, {self.dim}), got {embeddings.shape}.")
+        if labels.shape[0] != embeddings.shape[0]:
+            raise ValueError("Gallery embeddings and labels differ in length.")
+        self._emb, self._labels = embeddings, labels
+        self._n = embeddings.shape[0]
+        self._row_index = None
+        self._label_order = None
+
+    def row_of(self, label):
+        """Row holding `label`, -1 if absent. Meant for galleries with one row per label."""
+        if self._row_index is None:
+            # Built on first use only, so attaching a large snapshot stays cheap
+            self._row_index = {}
+            for row, l in enumerate(self.labels.tolist()):
+                self._row_index.setdefault(l, row)
+        return self._row_index.get(int(label), -1)
+
+    def rows_of(self, labels, return_owner=False):
+        """
+        Every row holding one of `labels`, found by bisection in a lazily sorted copy
+        of the labels, grouped in the order of `labels`. With `return_owner`, also
+        the index into `labels` of each row.
+        """
+        if self._label_order is None:
+            order = np.argsort(self.labels, kind="stable")
+            self._label_order = (order, self.labels[order])
+        order, sorted_labels = self._label_order
+        labels = np.asarray(labels, dtype=np.int64)
+        lo = np.searchsorted(sorted_labels, labels, side="left")
+        counts = np.searchsorted(sorted_labels, labels, side="right") - lo
+        if np.all(counts == 1):
+            rows, owner = order[lo], np.arange(labels.shape[0])
+        else:
+            starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+            rows, owner = order[starts + np.arange(starts.shape[0])], np.repeat(np.arange(labels.shape[0]), counts)
+        return (rows, owner) if return_owner else rows
+
+    def _reserve(self, n):
+        if n <= self._emb.shape[0] and self._emb.flags.writeable:
+            return
+        capacity = max(n, 2 * self._emb.shape[0], 1)
+        emb = np.empty((capacity, self.dim), dtype=np.float32)
+        labels = np.empty(capacity, dtype=np.int64)
+        emb[:self._n] = self._emb[:self._n]
+        labels[:self._n] = self._labels[:self._n]
+        self._emb, self._labels = emb, labels
+
+    def add(self, embeddings, labels):
+        """Appends L2-normalized copies of `embeddings`; returns their row indices."""
+        embeddings = np.atleast_2d(embeddings)
+        labels = np.atleast_1d(labels)
+        start, stop = self._n, self._n + embeddings.shape[0]
+        self._reserve(stop)
+        self._emb[start:stop] = l2_normalize(embeddings)
+        self._labels[start:stop] = labels
+        self._n = stop
+        if self._row_index is not None:
+            for row, l in zip(range(start, stop), self._labels[start:stop].tolist()):
+                self._row_index.setdefault(l, row)
+        if self._label_order is not None:
+            # Labels are mostly handed out in increasing order, so the sorted copy just grows
+            order, sorted_labels = self._label_order
+            new = self._labels[start:stop]
+            if sorted_labels.size and (new.min() < sorted_labels[-1] or np.any(np.diff(new) < 0)):
+                self._label_order = None
+            else:
+                self._label_order = (np.concatenate([order, np.arange(start, stop)]), np.concatenate([sorted_labels, new]))
+        return np.arange(start, stop)
+
+    def update(self, row, embedding):
+        """Replaces one row with an L2-normalized copy of `embedding`."""
+        self._reserve(self._n)
+        self._emb[row] = l2_normalize(embedding)
+
+    def remove_rows(self, rows):
+        """
+        Removes rows by moving the last rows into the gaps, so the matrix stays
+        contiguous. Returns {old_row: new_row} for every row that was moved.
+        """
+        self._reserve(self._n)
+        origin = {}
+        removed = []
+        for row in sorted(set(int(r) for r in rows), reverse=True):
+            last = self._n - 1
+            removed.append((origin.pop(row, row), int(self._labels[row])))
+            if row != last:
+                self._emb[row] = self._emb[last]
+                self._labels[row] = self._labels[last]
+                origin[row] = origin.pop(last, last)
+            self._n = last
+
+        self._label_order = None
+        if self._row_index is not None:
+            for old, label in removed:
+                if self._row_index.get(label) == old:
+                    del self._row_index[label]
+            for new, old in origin.items():
+                label = int(self._labels[new])
+                if self._row_index.get(label) == old:
+                    self._row_index[label] = new
+        return {old: new for new, old in origin.items()}
+
+    def search(self, queries, k=1, chunk=256):
+        """
+        Top-k cosine neighbours of each L2-normalized query.
+        Returns (rows, distances), both (n, k), best first; rows are -1 and distances
+        inf where the gallery holds fewer than k entries.
+        """
+        queries = np.atleast_2d(queries)
+        rows = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        distances = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        if self._n == 0:
+            return rows, distances
+
+        kk = min(k, self._n)
+        gallery = self.embeddings
+        for start in range(0, queries.shape[0], chunk):
+            sims = queries[start:start + chunk] @ gallery.T
+            if kk == 1:
+                top = np.argmax(sims, axis=1)[:, np.newaxis]
+            else:
+                top = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+                order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+                top = np.take_along_axis(top, order, axis=1)
+            rows[start:start + chunk, :kk] = top
+            distances[start:start + chunk, :kk] = 1.0 - np.take_along_axis(sims, top, axis=1)
+        return rows, distances
+
+def _kmeans(x, k, iters=15, seed=0):
+    """Plain Lloyd k-means used to train product-quantizer codebooks."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(x.shape[0], size=k, replace=x.shape[0] < k)].copy()
+    for _ in range(iters):
+        assign = _nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.stack([np.bincount(assign, weights=x[:, d], minlength=k) for d in range(x.shape[1])], axis=1)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+    return centroids
+
+def _nearest(x, centroids, chunk=8192):
+    norms = (centroids * centroids).sum(axis=1)
+    return np.concatenate([
+        np.argmin(norms - 2.0 * (x[start:start + chunk] @ centroids.T), axis=1)
+        for start in range(0, x.shape[0], chunk)
+    ]) if x.shape[0] else np.empty(0, dtype=np.int64)
+
+class CompressedGallery(EmbeddingGallery):
+    """
+    EmbeddingGallery for large galleries: full-precision rows live in a memory-mapped
+    temporary file, and only compact codes are scanned in RAM, either float16 copies
+    (2x smaller) or product-quantization codes of `subspaces` bytes per row, scored
+    with asymmetric distance computation (dim * 4 / subspaces times smaller). The
+    `rerank` best approximate candidates of every query are re-scored exactly
+    against the full-precision rows, so decisions match the float32 gallery as long
+    as the true nearest neighbour is among them.
+    """
+    def __init__(self, dim, storage="FLOAT16", subspaces=64, rerank=32, store_dir="", capacity=1024, train_size=4096):
+        self.storage = str(storage).upper()
+        self.subspaces = int(subspaces)
+        self.rerank = int(rerank)
+        self.train_size = int(train_size)
+
+        if self.storage not in ("FLOAT16", "PQ"): raise ValueError("Compressed gallery storage must be FLOAT16 or PQ.")
+        if self.storage == "PQ" and (self.subspaces < 1 or int(dim) % self.subspaces): raise ValueError("pqSubspaces must divide embeddingLength.")
+        if self.rerank < 1: raise ValueError("rerankDepth must be at least 1.")
+
+        self._file = tempfile.TemporaryFile(dir=store_dir or None)
+        super().__init__(dim, capacity)
+        self._emb = self._map(self._emb.shape[0])
+        # PQ codes are column-major so each subspace's codes are contiguous for the lookups
+        if self.storage == "FLOAT16":
+            self._codes = np.empty((self._emb.shape[0], self.dim), dtype=np.float16)
+        else:
+            self._codes = np.empty((self._emb.shape[0], self.subspaces), dtype=np.uint8, order="F")
+        self._codebooks = None
+        self._trainer = None
+
+    def _map(self, capacity):
+        self._file.truncate(capacity * self.dim * 4)
+        return np.memmap(self._file, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    @property
+    def code_bytes(self):
+        """RAM taken by the codes scanned at query time."""
+        return self._codes[:self._n].nbytes
+
+    def attach(self, embeddings, labels):
+        # Compressed galleries always copy: rows are encoded and moved to the backing file
+        self._n = 0
+        self._row_index = None
+        self._codebooks = None
+        self._trainer = None
+        for start in range(0, embeddings.shape[0], 65536):
+            self.add(embeddings[start:start + 65536], labels[start:start + 65536])
+
+    def _reserve(self, n):
+        if n <= self._emb.shape[0]:
+            return
+        capacity = max(n, 2 * self._emb.shape[0])
+        self._emb.flush()
+        self._emb = self._map(capacity)
+        labels = np.empty(capacity, dtype=np.int64)
+        labels[:self._n] = self._labels[:self._n]
+        codes = np.empty((capacity, self._codes.shape[1]), dtype=self._codes.dtype, order="C" if self.storage == "FLOAT16" else "F")
+        codes[:self._n] = self._codes[:self._n]
+        self._labels, self._codes = labels, codes
+
+    def add(self, embeddings, labels):
+        rows = super().add(embeddings, labels)
+        self._encode(rows[0], rows[-1] + 1 if rows.size else rows[0])
+        return rows
+
+    def update(self, row, embedding):
+        super().update(row, embedding)
+        self._encode(row, row + 1)
+
+    def remove_rows(self, rows):
+        moved = super().remove_rows(rows)
+        # Sources are tail rows past the new end, so their codes are still intact
+        for old, new in moved.items():
+            self._codes[new] = self._codes[old]
+        return moved
+
+    def _codes_ready(self):
+        """
+        PQ codebooks are trained in a background thread once train_size rows exist;
+        until they are ready the gallery is searched exactly. Returns True once usable.
+        """
+        if self.storage == "FLOAT16" or self._codebooks is not None:
+            return True
+        if self._trainer is None:
+            if self._n >= self.train_size:
+                rng = np.random.default_rng(0)
+                sample = np.asarray(self._emb[np.sort(rng.choice(self._n, size=min(self._n, 16384), replace=False))])
+                pool = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="mobrffi-pq")
+                self._trainer = pool.submit(self._train, sample)
+                pool.shutdown(wait=False)
+            return False
+        if not self._trainer.done():
+            return False
+        self._codebooks = self._trainer.result()
+        self._encode(0, self._n)
+        return True
+
+    def _encode(self, start, stop):
+        if self.storage == "FLOAT16":
+            self._codes[start:stop] = self._emb[start:stop]
+            return
+        if not self._codes_ready():
+            return
+        sub = self.dim // self.subspaces
+        x = np.asarray(self._emb[start:stop]).reshape(stop - start, self.subspaces, sub)
+        for m in range(self.subspaces):
+            self._codes[start:stop, m] = _nearest(x[:, m], self._codebooks[m])
+
+    def _train(self, sample):
+        sample = sample.reshape(sample.shape[0], self.subspaces, self.dim // self.subspaces)
+        return np.stack([_kmeans(sample[:, m], 256) for m in range(self.subspaces)]).astype(np.float32)
+
+    def _approx_scores(self, queries, lut, start, stop):
+        if self.storage == "FLOAT16":
+            return queries @ self._codes[start:stop].astype(np.float32).T
+        # Asymmetric distance: per-subspace query/centroid products looked up by code
+        scores = np.zeros((queries.shape[0], stop - start), dtype=np.float32)
+        for m in range(self.subspaces):
+            scores += np.take(lut[m], self._codes[start:stop, m], axis=1)
+        return scores
+
+    def search(self, queries, k=1, chunk=256, rows_chunk=65536):
+        if self._n == 0 or not self._codes_ready():
+            return super().search(queries, k=k, chunk=chunk)
+
+        queries = np.atleast_2d(queries)
+        rows = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        distances = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        kk = min(k, self._n)
+        depth = min(max(kk, self.rerank), self._n)
+
+        # Keep the (queries x rows) score block around 64 MB
+        q_chunk = max(1, min(chunk, (1 << 24) // self._n))
+        for q0 in range(0, queries.shape[0], q_chunk):
+            q = queries[q0:q0 + q_chunk]
+            lut = None
+            if self.storage == "PQ":
+                sub = self.dim // self.subspaces
+                lut = np.ascontiguousarray(np.einsum("bmd,mcd->mbc", q.reshape(q.shape[0], self.subspaces, sub), self._codebooks))
+            scores = np.concatenate([
+                self._approx_scores(q, lut, r0, min(r0 + rows_chunk, self._n))
+                for r0 in range(0, self._n, rows_chunk)
+            ], axis=1)
+            if depth < self._n:
+                cand = np.argpartition(-scores, depth - 1, axis=1)[:, :depth]
+            else:
+                cand = np.broadcast_to(np.arange(self._n), (q.shape[0], self._n))
+
+            # Exact re-ranking against the full-precision rows on disk, read in row order
+            cand = np.sort(cand, axis=1)
+            exact = np.einsum("brd,bd->br", self._emb[cand], q)
+            order = np.argsort(-exact, axis=1, kind="stable")[:, :kk]
+            rows[q0:q0 + q_chunk, :kk] = np.take_along_axis(cand, order, axis=1)
+            distances[q0:q0 + q_chunk, :kk] = 1.0 - np.take_along_axis(exact, order, axis=1)
+        return rows, distances
+
+class _InvertedList():
+    """Contiguous vectors and gallery rows of one IVF cell, in a buffer that doubles when full."""
+    __slots__ = ("vecs", "rows", "size")
+
+    def __init__(self, vecs, rows):
+        self.vecs = vecs
+        self.rows = rows
+        self.size = rows.shape[0]
+
+    def append(self, rows, vecs):
+        stop = self.size + rows.shape[0]
+        if stop > self.rows.shape[0]:
+            capacity = max(stop, 2 * self.rows.shape[0], 16)
+            grown = np.empty((capacity, self.vecs.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.vecs[:self.size]
+            grown_rows = np.empty(capacity, dtype=np.int64)
+            grown_rows[:self.size] = self.rows[:self.size]
+            self.vecs, self.rows = grown, grown_rows
+        self.vecs[self.size:stop] = vecs
+        self.rows[self.size:stop] = rows
+        positions = np.arange(self.size, stop)
+        self.size = stop
+        return positions
+
+    def remove(self, pos):
+        """Swap-removes entry `pos`; returns the gallery row moved into it, or -1."""
+        last = self.size - 1
+        moved = -1
+        if pos != last:
+            self.vecs[pos] = self.vecs[last]
+            self.rows[pos] = self.rows[last]
+            moved = int(self.rows[pos])
+        self.size = last
+        return moved
+
+class IVFGallery(EmbeddingGallery):
+    """
+    EmbeddingGallery with an inverted-file index: k-means coarse centroids, and per
+    cell a contiguous copy of its vectors. A query scans only the `nprobe` cells
+    whose centroids are closest, so results are approximate.
+
+    The index is (re)trained in a background thread, first once `train_size` rows
+    exist and again whenever the gallery has grown `retrain_growth` times since the
+    last training; until then queries are exact. Inserts, updates and removals are
+    applied to the live index immediately, and replayed onto a index being rebuilt.
+    """
+    def __init__(self, dim, nlist=0, nprobe=8, capacity=1024, train_size=4096, retrain_growth=2.0):
+        super().__init__(dim, capacity)
+        self.nlist = int(nlist)
+        self.nprobe = int(nprobe)
+        self.train_size = int(train_size)
+        self.retrain_growth = float(retrain_growth)
+
+        if self.nlist < 0: raise ValueError("ivfLists must be non-negative (0 picks 4 * sqrt(N)).")
+        if self.nprobe < 1: raise ValueError("ivfProbe must be at least 1.")
+
+        self._reset_index()
+
+    def _reset_index(self):
+        self._centroids = None
+        self._lists = None
+        self._list_of = np.full(self._emb.shape[0], -1, dtype=np.int32)
+        self._pos = np.zeros(self._emb.shape[0], dtype=np.int64)
+        self._trainer = None
+        self._trained_n = 0
+        self._changed = None
+
+    def attach(self, embeddings, labels):
+        super().attach(embeddings, labels)
+        self._reset_index()
+
+    def _reserve(self, n):
+        super()._reserve(n)
+        capacity = self._emb.shape[0]
+        if capacity != self._list_of.shape[0]:
+            list_of = np.full(capacity, -1, dtype=np.int32)
+            pos = np.zeros(capacity, dtype=np.int64)
+            keep = min(capacity, self._list_of.shape[0])
+            list_of[:keep], pos[:keep] = self._list_of[:keep], self._pos[:keep]
+            self._list_of, self._pos = list_of, pos
+
+    @property
+    def cells(self):
+        """Number of cells of the installed index (0 before the first training)."""
+        return 0 if self._lists is None else len(self._lists)
+
+    def wait_ready(self):
+        """Blocks until a pending (re)training has been installed; returns whether the index is usable."""
+        if self._trainer is not None:
+            futures.wait([self._trainer])
+        return self._index_ready()
+
+    def _index_ready(self):
+        if self._trainer is not None and self._trainer.done():
+            self._install(*self._trainer.result())
+        if self._trainer is None and self._n >= max(self.train_size, self._trained_n * self.retrain_growth):
+            # Rows touched from now on are replayed when the new index is installed
+            self._changed = set()
+            pool = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="mobrffi-ivf")
+            self._trainer = pool.submit(self._build, self._emb, self._n)
+            pool.shutdown(wait=False)
+        return self._centroids is not None
+
+    def _build(self, emb, n):
+        """Trains centroids on a sample of the first n rows and fills the cells (background thread)."""
+        nlist = min(self.nlist or max(1, int(4 * np.sqrt(n))), n)
+        rng = np.random.default_rng(0)
+        sample = np.asarray(emb[np.sort(rng.choice(n, size=min(n, max(65536, 40 * nlist)), replace=False))])
+        centroids = l2_normalize(_kmeans(sample, nlist))
+
+        assign = np.concatenate([
+            np.argmax(emb[start:min(start + 65536, n)] @ centroids.T, axis=1)
+            for start in range(0, n, 65536)
+        ]).astype(np.int32)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+
+        lists, pos = [], np.empty(n, dtype=np.int64)
+        for l in range(nlist):
+            rows = order[bounds[l]:bounds[l + 1]]
+            lists.append(_InvertedList(np.asarray(emb[rows], dtype=np.float32), rows.astype(np.int64)))
+            pos[rows] = np.arange(rows.shape[0])
+        return centroids, lists, assign, pos, n
+
+    def _install(self, centroids, lists, list_of, pos, n):
+        changed, self._changed, self._trainer = self._changed, None, None
+        self._centroids, self._lists = centroids, lists
+        self._list_of[:n], self._pos[:n] = list_of, pos
+        self._trained_n = n
+
+        # Replay what happened while the index was built: rows removed from the tail,
+        # rows updated or filled by a removal, and rows added since
+        for row in range(n - 1, self._n - 1, -1):
+            self._drop(row)
+        for row in sorted(r for r in changed if r < min(n, self._n)):
+            self._drop(row)
+            self._insert(np.array([row]))
+        if self._n > n:
+            self._insert(np.arange(n, self._n))
+
+    def _drop(self, row):
+        l = self._list_of[row]
+        if l < 0:
+            return
+        moved = self._lists[l].remove(self._pos[row])
+        if moved >= 0:
+            self._pos[moved] = self._pos[row]
+        self._list_of[row] = -1
+
+    def _insert(self, rows):
+        vecs = self._emb[rows]
+        assign = np.argmax(vecs @ self._centroids.T, axis=1)
+        for l in np.unique(assign).tolist():
+            sel = assign == l
+            self._pos[rows[sel]] = self._lists[l].append(rows[sel], vecs[sel])
+            self._list_of[rows[sel]] = l
+
+    def add(self, embeddings, labels):
+        rows = super().add(embeddings, labels)
+        if self._centroids is not None:
+            self._insert(rows)
+        self._index_ready()
+        return rows
+
+    def update(self, row, embedding):
+        super().update(row, embedding)
+        if self._centroids is not None:
+            self._drop(row)
+            self._insert(np.array([row]))
+        if self._changed is not None:
+            self._changed.add(int(row))
+
+    def remove_rows(self, rows):
+        if self._centroids is not None:
+            for row in rows:
+                self._drop(int(row))
+        moved = super().remove_rows(rows)
+        for old, new in moved.items():
+            l = self._list_of[old]
+            if l >= 0:
+                self._lists[l].rows[self._pos[old]] = new
+                self._list_of[new], self._pos[new] = l, self._pos[old]
+                self._list_of[old] = -1
+            if self._changed is not None:
+                self._changed.add(new)
+        return moved
+
+    def search(self, queries, k=1, chunk=256):
+        if self._n == 0 or not self._index_ready():
+            return super().search(queries, k=k, chunk=chunk)
+
+        queries = np.atleast_2d(queries)
+        b = queries.shape[0]
+        nprobe = min(self.nprobe, self._centroids.shape[0])
+        coarse = queries @ self._centroids.T
+        if nprobe < coarse.shape[1]:
+            probe = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probe = np.broadcast_to(np.arange(nprobe), (b, nprobe))
+
+        # Every probed cell is scanned once, for all the queries that probe it
+        cand_rows = np.full((b, nprobe * k), -1, dtype=np.int64)
+        cand_sims = np.full((b, nprobe * k), -np.inf, dtype=np.float32)
+        flat = probe.ravel()
+        order = np.argsort(flat, kind="stable")
+        cells, starts = np.unique(flat[order], return_index=True)
+        for l, start, stop in zip(cells.tolist(), starts.tolist(), np.append(starts[1:], flat.shape[0]).tolist()):
+            cell = self._lists[l]
+            if cell.size == 0:
+                continue
+            entries = order[start:stop]
+            q_idx, slot = entries // nprobe, entries % nprobe
+            sims = queries[q_idx] @ cell.vecs[:cell.size].T
+            kk = min(k, cell.size)
+            top = np.argpartition(-sims, kk - 1, axis=1)[:, :kk] if kk < cell.size else np.broadcast_to(np.arange(kk), (q_idx.shape[0], kk))
+            cols = slot[:, np.newaxis] * k + np.arange(kk)
+            cand_rows[q_idx[:, np.newaxis], cols] = cell.rows[top]
+            cand_sims[q_idx[:, np.newaxis], cols] = np.take_along_axis(sims, top, axis=1)
+
+        best = np.argsort(-cand_sims, axis=1, kind="stable")[:, :k]
+        sims = np.take_along_axis(cand_sims, best, axis=1)
+        rows = np.where(np.isfinite(sims), np.take_along_axis(cand_rows, best, axis=1), -1)
+        distances = np.where(np.isfinite(sims), 1.0 - sims, np.inf).astype(np.float32)
+        if rows.shape[1] < k:
+            pad = k - rows.shape[1]
+            rows = np.pad(rows, ((0, 0), (0, pad)), constant_values=-1)
+            distances = np.pad(distances, ((0, 0), (0, pad)), constant_values=np.inf)
+        return rows, distances
+
+class CfoIndex():
+    """
+    Running carrier frequency offset (Hz) of every device, kept sorted so that the
+    devices whose CFO lies within a window are found with two bisections.
+    """
+    def __init__(self):
+        self._keys = []           # CFOs in ascending order
+        self._labels = []         # label of each entry of _keys
+        self._cfo = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, label, default=float("nan")):
+        return self._cfo.get(label, default)
+
+    def update(self, label, cfo, alpha=1.0):
+        """Folds an observation into the device's CFO (an EMA with weight `alpha`; the first one is taken as is)."""
+        old = self._cfo.get(label)
+        new = float(cfo) if old is None else (1.0 - alpha) * old + alpha * float(cfo)
+        if old is not None:
+            self._pop(label, old)
+        j = bisect.bisect_right(self._keys, new)
+        self._keys.insert(j, new)
+        self._labels.insert(j, label)
+        self._cfo[label] = new
+        return new
+
+    def remove(self, label):
+        old = self._cfo.pop(label, None)
+        if old is not None:
+            self._pop(label, old)
+
+    def _pop(self, label, cfo):
+        j = bisect.bisect_left(self._keys, cfo)
+        while self._labels[j] != label:
+            j += 1
+        del self._keys[j]
+        del self._labels[j]
+
+    def window(self, cfo, width):
+        """Labels of the devices whose CFO is within `width` Hz of `cfo`."""
+        return self._labels[bisect.bisect_left(self._keys, cfo - width):bisect.bisect_right(self._keys, cfo + width)]
+
+    def bounds(self, cfos, width):
+        """Vectorized window(): the [lo, hi) positions in labels_between() of every window."""
+        keys = np.asarray(self._keys)
+        cfos = np.asarray(cfos, dtype=np.float64)
+        return np.searchsorted(keys, cfos - width, side="left"), np.searchsorted(keys, cfos + width, side="right")
+
+    def labels_between(self, lo, hi):
+        """Labels at sorted positions lo to hi, in ascending order of CFO."""
+        return self._labels[lo:hi]
+
+# Columnar per-device table stored next to the embedding matrix, one row per gallery row
+LABEL_TABLE_DTYPE = np.dtype([
+    ("label", np.int64),
+    ("enrolled_at", np.float64),
+    ("last_update", np.float64),
+    ("count", np.int64),
+])
+
+def _save_npy(path, arr):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+def save_snapshot(path, embeddings, table, next_label, dtype=np.float32):
+    """
+    Writes a gallery snapshot to directory `path`: the (N, D) embedding matrix as
+    float32 or float16 .npy, the label table (LABEL_TABLE_DTYPE) as .npy and a
+    meta.json naming both. Every snapshot gets new file names and meta.json is
+    replaced last, so readers see either the old or the new snapshot, never a mix.
+    The previous generation is kept until the next save, so a reader that read the
+    old meta.json just before the swap can still open its files.
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float16): raise ValueError("Snapshot embeddings must be float32 or float16.")
+    if table.dtype != LABEL_TABLE_DTYPE or table.shape[0] != embeddings.shape[0]:
+        raise ValueError("Snapshot label table must have one LABEL_TABLE_DTYPE row per embedding.")
+
+    os.makedirs(path, exist_ok=True)
+    old = _read_meta(path)
+    generation = (old["generation"] + 1) if old else 1
+
+    files = {"embeddings": f"embeddings.{generation}.npy", "table": f"labels.{generation}.npy"}
+    _save_npy(os.path.join(path, files["embeddings"]), np.ascontiguousarray(embeddings, dtype=dtype))
+    _save_npy(os.path.join(path, files["table"]), np.ascontiguousarray(table))
+
+    meta = {
+        "version": _SNAPSHOT_VERSION,
+        "generation": generation,
+        "dim": int(embeddings.shape[1]),
+        "rows": int(embeddings.shape[0]),
+        "dtype": dtype.name,
+        "next_label": int(next_label),
+        "files": files,
+    }
+    tmp_path = os.path.join(path, f"meta.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, "meta.json"))
+
+    # Drop generations older than the previous one; unlinking keeps existing memory maps valid
+    for name in os.listdir(path):
+        match = _SNAPSHOT_FILE.fullmatch(name)
+        if match and int(match.group(1)) < generation - 1:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+def _read_meta(path):
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("version") != _SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported gallery snapshot version in {path}: {meta.get('version')}")
+    return meta
+
+def load_snapshot(path):
+    """
+    Memory-maps a snapshot written by save_snapshot(); returns (embeddings, table, meta),
+    or None if `path` holds no snapshot. Both arrays are read-only.
+    """
+    meta = _read_meta(path)
+    if meta is None:
+        return None
+
+    embeddings = np.load(os.path.join(path, meta["files"]["embeddings"]), mmap_mode="r")
+    table = np.load(os.path.join(path, meta["files"]["table"]), mmap_mode="r")
+    if embeddings.shape != (meta["rows"], meta["dim"]) or table.shape != (meta["rows"],):
+        raise ValueError(f"Gallery snapshot in {path} is inconsistent with its meta.json.")
+    return embeddings, table, meta
@@ -1,74 +1,285 @@
 import os
+import time
+import hashlib
 import logging
+import threading
+from collections import deque
+from concurrent import futures
+import pmt
 import numpy as np
 from gnuradio import gr
-from scipy import signal
+from scipy import fft as sp_fft
+from numpy.lib.stride_tricks import sliding_window_view
+from .metrics import BlockMetrics
 
 try:
     import onnxruntime as ort
 except Exception as e:
     raise ImportError("onnxruntime is required: `pip install onnxruntime-gpu`")
 
-class ChannelIndSpectrogram():
-    def __init__(self,):
-        pass
-    
-    def _normalization(self, data):
-        data_normalized = np.zeros(data.shape, dtype=complex)
-        for i in range(data.shape[0]):
-            data_normalized[i] = data[i] / np.sqrt(np.mean(np.abs(data[i])**2))
-        return data_normalized        
-
-    def _channel_ind_spectrogram_single(self, frame, win_len, overlap, enable_ind=True):
-        _, t, spec = signal.stft(frame, window = 'boxcar', 
-                                nperseg = win_len, noverlap = overlap, 
-                                nfft = win_len, return_onesided = False, 
-                                padded = False, boundary = None)
-        spec = np.fft.fftshift(spec, axes=0)
+# Guard and DC subcarriers of the 80-bin (fftshift-ed) spectrogram that carry no fingerprint
+_GUARD_SUBCARRIERS = list(range(0, 14)) + [40] + list(range(67, 80))
+
+class SpectrogramPlan():
+    """
+    Channel-independent spectrogram for a fixed (vectorLength, specWidth, overlap).
+
+    Output shape, the kept-subcarrier gather index and float32/complex64 scratch
+    buffers are computed once; execute() reuses them and writes the standardized
+    spectrograms straight into a caller-provided (B, F, T, 1) float32 buffer.
+    """
+    def __init__(self, vector_length, win_len, overlap_coef=0.9, enable_ind=True, remove_subcarriers=True, max_batch=1):
+        self.vector_length = int(vector_length)
+        self.win_len = int(win_len)
+        self.enable_ind = bool(enable_ind)
+        self.step = self.win_len - int(self.win_len * overlap_coef)
+
+        if self.win_len <= 0 or self.win_len > self.vector_length: raise ValueError("win_len must be within (0, vector_length].")
+        if self.step <= 0: raise ValueError("overlap_coef leaves no hop between segments.")
+
+        # Segment timing matches scipy.signal.stft(padded=False, boundary=None)
+        self.n_seg = (self.vector_length - self.win_len) // self.step + 1
+        self.t = (self.win_len / 2) + self.step * np.arange(self.n_seg)
+        n_time = self.n_seg - 1 if self.enable_ind else self.n_seg
+
+        # Kept subcarriers in fftshift-ed order, mapped back to raw FFT bins
+        keep = np.arange(self.win_len)
+        if remove_subcarriers:
+            keep = np.delete(keep, _GUARD_SUBCARRIERS)
+        fft_bins = (keep - self.win_len // 2) % self.win_len
+
+        # Flat gather index: out[f, t] = spec[t, fft_bins[f]] for a time-major (T, win_len) spectrogram
+        self._gather = (np.arange(n_time)[np.newaxis, :] * self.win_len + fft_bins[:, np.newaxis]).ravel()
+
+        self.shape = (len(keep), n_time, 1)
+        self.capacity = 0
+        self._reserve(max(1, int(max_batch)))
+
+    def _reserve(self, batch):
+        n_time = self.shape[1]
+        self._amp = np.empty((batch, self.vector_length), dtype=np.float32)
+        self._scale = np.empty((batch, 1), dtype=np.float32)
+        self._norm = np.empty((batch, self.vector_length), dtype=np.complex64)
+        self._ratio = np.empty((batch, n_time, self.win_len), dtype=np.complex64)
+        self._mag = np.empty((batch, n_time, self.win_len), dtype=np.float32)
+        self._mean = np.empty((batch, 1), dtype=np.float32)
+        self._std = np.empty((batch, 1), dtype=np.float32)
+        self.capacity = batch
+
+    def empty(self, batch):
+        return np.empty((int(batch),) + self.shape, dtype=np.float32)
+
+    def execute(self, data, out=None):
+        data = np.atleast_2d(data)
+        n = data.shape[0]
+        if data.shape[1] != self.vector_length: raise ValueError(f"Expected {self.vector_length} IQ samples per frame, received {data.shape[1]}.")
+        if n > self.capacity: self._reserve(n)
+        if out is None: out = self.empty(n)
+
+        # Normalize IQ samples to unit average power
+        amp, scale, norm = self._amp[:n], self._scale[:n], self._norm[:n]
+        np.abs(data, out=amp)
+        np.square(amp, out=amp)
+        np.mean(amp, axis=1, keepdims=True, out=scale)
+        np.sqrt(scale, out=scale)
+        np.divide(data, scale, out=norm)
+
+        # Boxcar STFT is the plain FFT of each strided segment. Its 1/win_len scaling only
+        # shifts the log-spectrogram by a constant, which standardization removes.
+        segments = sliding_window_view(norm, self.win_len, axis=1)[:, ::self.step, :]
+        spec = sp_fft.fft(segments, axis=2)
 
         # If enabled, produce channel-independent spectrogram
-        if enable_ind:
-            spec = spec[:, 1:] / spec[:, :-1]
+        mag = self._mag[:n]
+        if self.enable_ind:
+            ratio = self._ratio[:n]
+            np.divide(spec[:, 1:, :], spec[:, :-1, :], out=ratio)
+            np.abs(ratio, out=mag)
+        else:
+            np.abs(spec, out=mag)
 
-        # Return logarithm of the spectrogram magnitude
-        spec = np.log10(np.abs(spec)**2)
+        # Logarithm of the spectrogram magnitude
+        np.square(mag, out=mag)
+        np.log10(mag, out=mag)
 
-        # Apply standardization to obtain more spectrogram consistency
-        spec = self._standardization(spec)
+        # Per-frame standardization statistics over the full spectrogram
+        flat = mag.reshape(n, -1)
+        mean, std = self._mean[:n], self._std[:n]
+        np.mean(flat, axis=1, keepdims=True, out=mean)
+        np.std(flat, axis=1, keepdims=True, out=std)
 
-        return t, spec
+        # Gather kept subcarriers in (F, T) order straight into the output buffer
+        out_flat = out.reshape(n, -1)
+        np.take(flat, self._gather, axis=1, out=out_flat)
+        out_flat -= mean
+        out_flat /= std
 
-    def _standardization(self, spec):
-        mean = spec.mean()
-        std = spec.std()
-        spec = (spec - mean) / std
-        return spec
+        return out
+
+class ChannelIndSpectrogram():
+    def __init__(self,):
+        self._plans = {}
+
+    def plan(self, vector_length, row, enable_ind=True, overlap_coef=0.9, remove_subcarriers=True):
+        key = (int(vector_length), int(row), float(overlap_coef), bool(enable_ind), bool(remove_subcarriers))
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = SpectrogramPlan(vector_length, row, overlap_coef=overlap_coef, enable_ind=enable_ind, remove_subcarriers=remove_subcarriers)
+            self._plans[key] = plan
+        return plan
 
     def channel_ind_spectrogram(self, data, row, enable_ind, overlap_coef = 0.9, remove_subcarriers=True, return_spec_t=False):
-        # Normalize IQ samples
-        data = self._normalization(data)
+        data = np.atleast_2d(data)
+        plan = self.plan(data.shape[1], row, enable_ind=enable_ind, overlap_coef=overlap_coef, remove_subcarriers=remove_subcarriers)
+        data_spectrograms = plan.execute(data)
 
-        overlap = row * overlap_coef
+        if return_spec_t: return data_spectrograms, plan.t
+        else: return data_spectrograms
 
-        # Produce spectrogram once to dynamically determine input array dimensions
-        t, test_run = self._channel_ind_spectrogram_single(data[0], win_len=row, overlap=overlap, enable_ind=enable_ind)
+def preamble_quality(iq, metric, stf_lag=20, stf_len=200):
+    """
+    Cheap per-frame quality score for an (N, L) block of preambles.
+    STF : normalized lag-stf_lag autocorrelation magnitude over the L-STF, in [0, 1]
+    RMS : root-mean-square amplitude
+    PAPR: peak-to-average power ratio in dB
+    """
+    if metric == "STF":
+        stf = iq[:, :stf_len]
+        a, b = stf[:, :-stf_lag], stf[:, stf_lag:]
+        corr = np.abs(np.sum(np.conj(a) * b, axis=1))
+        energy = np.sqrt(np.sum(np.abs(a)**2, axis=1) * np.sum(np.abs(b)**2, axis=1))
+        return corr / energy
 
-        # Convert each packet (IQ samples) to a channel independent spectrogram.
-        data_spectrograms = np.zeros([data.shape[0], test_run.shape[0], test_run.shape[1], 1], dtype=np.float32)
+    power = np.abs(iq)**2
+    if metric == "RMS":
+        return np.sqrt(power.mean(axis=1))
+    if metric == "PAPR":
+        return 10 * np.log10(power.max(axis=1) / power.mean(axis=1))
+    raise ValueError(f"Unknown preamble quality metric: {metric}")
 
-        # Run STFT for each frame separately
-        for i in np.arange(data.shape[0]):
-            _, spec = self._channel_ind_spectrogram_single(data[i], win_len=row, overlap=overlap, enable_ind=enable_ind)
-            data_spectrograms[i,:,:,0] = spec.astype(np.float32)
+# Block parameter values mapped to onnxruntime enum member names
+_GRAPH_OPT_LEVELS = {
+    "DISABLE": "ORT_DISABLE_ALL",
+    "BASIC": "ORT_ENABLE_BASIC",
+    "EXTENDED": "ORT_ENABLE_EXTENDED",
+    "ALL": "ORT_ENABLE_ALL",
+}
+_EXECUTION_MODES = {
+    "SEQUENTIAL": "ORT_SEQUENTIAL",
+    "PARALLEL": "ORT_PARALLEL",
+}
 
-        if remove_subcarriers:
-            guards = list(range(0, 14)) + [40] + list(range(67, 80))
-            data_spectrograms = np.delete(data_spectrograms, guards, axis=1)
+class _InferenceEngine():
+    """
+    ONNX session plus the spectrogram plan and input workspace feeding it.
+    Not thread-safe: every inference thread owns its own engine.
+    """
+    def __init__(self, session, vector_length, spec_width, embedding_length, max_batch, log, metrics):
+        self._session = session
+        self._in_name = session.get_inputs()[0].name
+        self._out_name = session.get_outputs()[0].name
+        self._in_dtype = np.float16 if session.get_inputs()[0].type == "tensor(float16)" else np.float32
+        self._embedding_length = int(embedding_length)
+        self._max_batch = int(max_batch)
+        self._log = log
+        self._metrics = metrics
 
-        if return_spec_t: return data_spectrograms, t
-        else: return data_spectrograms
+        # Models exported with a fixed batch dimension can only take one frame per run
+        batch_dim = session.get_inputs()[0].shape[0]
+        self.batched = self._max_batch > 1 and not isinstance(batch_dim, int)
+
+        # Spectrogram plan and the ONNX input workspace it writes into
+        self._spec_plan = SpectrogramPlan(vector_length, spec_width, max_batch=self._max_batch)
+        self._spec_buf = self._spec_plan.empty(self._max_batch)
+
+        # Zero-copy path: bind the input workspace and the destination rows as ORT buffers.
+        # Only for a declared (B, embeddingLength) output; anything else goes through run() + reshape.
+        self._binding = None
+        out_info = session.get_outputs()[0]
+        out_shape = list(out_info.shape or [])
+        if (self._in_dtype == np.float32 and out_info.type == "tensor(float)"
+                and len(out_shape) == 2 and out_shape[1] == self._embedding_length):
+            self._binding = session.io_binding()
+
+    def _infer_into(self, spec, out_rows):
+        """
+        Runs the model on spec and writes the (B, embeddingLength) result into out_rows.
+        Returns False, writing nothing, if the model output has the wrong size.
+        """
+        if self._binding is not None and out_rows.flags.c_contiguous:
+            self._binding.bind_cpu_input(self._in_name, spec)
+            self._binding.bind_output(self._out_name, "cpu", 0, np.float32, list(out_rows.shape), out_rows.ctypes.data)
+            self._session.run_with_iobinding(self._binding)
+            return True
+
+        out = self._session.run([self._out_name], {self._in_name: spec.astype(self._in_dtype, copy=False)})[0]
+        embeddings = np.asarray(out).reshape(spec.shape[0], -1)
+        if embeddings.shape[1] != self._embedding_length:
+            self._metrics.count("errors")
+            self._log.error(f"Model output has incorrect size: {embeddings.shape}")
+            return False
+        out_rows[...] = embeddings
+        return True
+
+    def fingerprint(self, rows, out_mat, kept=None):
+        """
+        Writes embeddings of `rows` to the head of out_mat; returns how many were written.
+        Frames that fail spectrogram generation or inference are dropped; if given, `kept`
+        is extended with the row index behind every written embedding.
+        """
+        if not self.batched:
+            return self._fingerprint_per_frame(rows, out_mat, kept)
+
+        produced = 0
+        for start in range(0, rows.shape[0], self._max_batch):
+            stop = min(start + self._max_batch, rows.shape[0])
+
+            # Stack the whole chunk into one (B, F, T, 1) tensor and run inference once
+            try:
+                with self._metrics.time("spectrogram"):
+                    spec = self._spec_plan.execute(rows[start:stop], out=self._spec_buf[:stop - start])
+                with self._metrics.time("inference"):
+                    written = self._infer_into(spec, out_mat[produced:produced + stop - start])
+            except Exception as e:
+                self._metrics.count("errors")
+                self._log.error(f"Batched inference failed, retrying frame by frame: {e}")
+                produced += self._fingerprint_per_frame(rows[start:stop], out_mat[produced:], kept, start)
+                continue
+
+            if written:
+                produced += stop - start
+                if kept is not None:
+                    kept.extend(range(start, stop))
+
+        return produced
+
+    def _fingerprint_per_frame(self, rows, out_mat, kept=None, offset=0):
+        produced = 0
+        for i in range(rows.shape[0]):
+            try:
+                with self._metrics.time("spectrogram"):
+                    spec = self._spec_plan.execute(rows[i:i + 1], out=self._spec_buf[:1])
+            except Exception as e:
+                self._metrics.count("errors")
+                self._log.error(f"Failed to produce a channel-independent spectrogram: {e}")
+                continue
+
+            try:
+                with self._metrics.time("inference"):
+                    written = self._infer_into(spec, out_mat[produced:produced + 1])
+            except Exception as e:
+                self._metrics.count("errors")
+                self._log.error(f"ONNX inference failed: {e}")
+                continue
 
-class get_fingerprint(gr.sync_block):
+            if written:
+                produced += 1
+                if kept is not None:
+                    kept.append(offset + i)
+
+        return produced
+
+class get_fingerprint(gr.basic_block):
     """
     docstring for block get_fingerprint
     """
@@ -77,12 +288,27 @@ class get_fingerprint(gr.sync_block):
                  embeddingLength=768,
                  specWidth=80,
                  modelPath='/path/to/model.onnx',
-                 computeMode='CPU'):
-        gr.sync_block.__init__(
+                 computeMode='CPU',
+                 maxBatchSize=32,
+                 maxLatencyMs=0.0,
+                 numWorkers=0,
+                 intraOpThreads=0,
+                 interOpThreads=0,
+                 graphOptLevel='ALL',
+                 executionMode='SEQUENTIAL',
+                 modelCacheDir='',
+                 sampleRate=25e6,
+                 gateMetric='OFF',
+                 gateThreshold=0.5,
+                 gateAction='DROP',
+                 cfoInput=False,
+                 metricsInterval=5.0,
+                 metricsFile=''):
+        gr.basic_block.__init__(
             self,
             name="MobRFFI Fingerprint Extractor",
-            in_sig=[(np.complex64, int(vectorLength))],
-            out_sig=[(np.float32, int(embeddingLength))]
+            in_sig=[(np.complex64, int(vectorLength))] + ([np.float32] if cfoInput else []),
+            out_sig=[(np.float32, int(embeddingLength))] + ([np.float32] if cfoInput else [])
         )
 
         # Parameters
@@ -91,6 +317,19 @@ class get_fingerprint(gr.sync_block):
         self.specWidth = int(specWidth)
         self.modelPath = str(modelPath)
         self.computeMode = str(computeMode).upper().strip()
+        self.maxBatchSize = int(maxBatchSize)
+        self.maxLatencyMs = float(maxLatencyMs)
+        self.numWorkers = int(numWorkers)
+        self.intraOpThreads = int(intraOpThreads)
+        self.interOpThreads = int(interOpThreads)
+        self.graphOptLevel = str(graphOptLevel).upper().strip()
+        self.executionMode = str(executionMode).upper().strip()
+        self.modelCacheDir = str(modelCacheDir).strip()
+        self.sampleRate = float(sampleRate)
+        self.gateMetric = str(gateMetric).upper().strip()
+        self.gateThreshold = float(gateThreshold)
+        self.gateAction = str(gateAction).upper().strip()
+        self.cfoInput = bool(cfoInput)
 
         # Logging
         self._log = logging.getLogger("mobrffi.extractor")
@@ -104,53 +343,290 @@ class get_fingerprint(gr.sync_block):
         if self.vectorLength < 320: raise ValueError("vectorLength must be at least 320 IQ samples long.")
         if self.embeddingLength < 512: raise ValueError("embeddingLength must be at least 512 values long.")
         if self.specWidth <= 0: raise ValueError("specWidth has to be a positive integer.")
+        if self.maxBatchSize <= 0: raise ValueError("maxBatchSize has to be a positive integer.")
+        if self.maxLatencyMs < 0: raise ValueError("maxLatencyMs must be non-negative.")
+        if self.numWorkers < 0: raise ValueError("numWorkers must be non-negative.")
+        if self.intraOpThreads < 0 or self.interOpThreads < 0: raise ValueError("ONNX Runtime thread counts must be non-negative (0 = runtime default).")
+        if self.graphOptLevel not in _GRAPH_OPT_LEVELS: raise ValueError(f"graphOptLevel must be one of {list(_GRAPH_OPT_LEVELS)}.")
+        if self.executionMode not in _EXECUTION_MODES: raise ValueError(f"executionMode must be one of {list(_EXECUTION_MODES)}.")
+        if self.sampleRate <= 0: raise ValueError("sampleRate must be positive.")
+        if self.gateMetric not in ("OFF", "STF", "RMS", "PAPR"): raise ValueError("gateMetric must be one of OFF, STF, RMS, PAPR.")
+        if self.gateAction not in ("DROP", "FLAG"): raise ValueError("gateAction must be either DROP or FLAG.")
         if not os.path.isfile(self.modelPath): raise FileNotFoundError(f"ONNX model isn't found here: {self.modelPath}")
 
-        # ONNX runtime session
-        providers = ["CPUExecutionProvider"]
+        # With a worker pool, sessions split the cores instead of each sizing its pool to all of them
+        self._intra_op_threads = self.intraOpThreads
+        if self._intra_op_threads == 0 and self.numWorkers > 0:
+            self._intra_op_threads = max(1, (os.cpu_count() or 1) // self.numWorkers)
+
+        # Instrumentation, published on the "metrics" message port every metricsInterval seconds
+        self._metrics = BlockMetrics("get_fingerprint", self.unique_id(), interval=metricsInterval, path=metricsFile, log=self._log)
+        self._metrics_port = pmt.intern("metrics")
+        self.message_port_register_out(self._metrics_port)
+
+        # ONNX runtime providers
+        self._providers = ["CPUExecutionProvider"]
         if self.computeMode == "GPU" and "CUDAExecutionProvider" in ort.get_available_providers():
-            providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+            self._providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
             self._log.info("Using GPU provider for ONNX Runtime.")
         else:
             self._log.info("Using CPU provider for ONNX Runtime.")
-        self._session = ort.InferenceSession(self.modelPath, providers=providers)
-        self._in_name = self._session.get_inputs()[0].name
-        self._out_name = self._session.get_outputs()[0].name
 
-        # Initialize channel-independent spectrogram generator
-        self._ch_ind_spec_generator = ChannelIndSpectrogram()
+        # Optimized-model cache, keyed by model content and everything that shapes the optimized graph
+        self._cached_model_path = None
+        if self.modelCacheDir:
+            os.makedirs(self.modelCacheDir, exist_ok=True)
+            self._cached_model_path = os.path.join(self.modelCacheDir, f"{self._model_cache_key()}.onnx")
+
+        # Inference engine used on the scheduler thread (also validates the model upfront)
+        self._engine = self._make_engine()
+        if self.maxBatchSize > 1 and not self._engine.batched:
+            self._log.info("Model has a fixed batch dimension; using per-frame inference.")
+
+        # Micro-batcher: vectors held back until the batch fills or the oldest one is
+        # maxLatencyMs old. A latency of 0 processes whatever the scheduler hands us.
+        self._max_latency_s = self.maxLatencyMs / 1e3
+        self._poll_s = max(self._max_latency_s / 4, 1e-3)
+        self._pending = np.empty((self.maxBatchSize, self.vectorLength), dtype=np.complex64)
+        self._pending_cfo = np.empty(self.maxBatchSize, dtype=np.float32)
+        self._n_pending = 0
+        self._pending_since = 0.0
+
+        # Preamble quality gate: the 16-sample STF period and 160-sample L-STF scale with the rate
+        self._gate_lag = max(1, int(round(16 * self.sampleRate / 20e6)))
+        self._gate_stf_len = min(self.vectorLength, int(round(160 * self.sampleRate / 20e6)))
+        self._gate_scored = 0
+        self._gate_failed = 0
+        self._low_quality_key = pmt.intern("low_quality")
+
+        # Optional worker pool: each thread owns an engine (ORT releases the GIL during run),
+        # results are emitted in submission order with at most two batches in flight per worker
+        self._pool = None
+        self._inflight = deque()
+        self._max_inflight = 2 * self.numWorkers
+        self._worker_state = threading.local()
+        if self.numWorkers > 0:
+            self._pool = futures.ThreadPoolExecutor(max_workers=self.numWorkers, thread_name_prefix="mobrffi-infer")
+            self._log.info(f"Running inference on {self.numWorkers} worker threads, {self._intra_op_threads} intra-op threads each.")
+
+    def _model_cache_key(self):
+        digest = hashlib.sha256()
+        with open(self.modelPath, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(f"|{self.graphOptLevel}|{','.join(self._providers)}|{ort.__version__}".encode())
+        return digest.hexdigest()[:32]
+
+    def _session_options(self):
+        so = ort.SessionOptions()
+        so.intra_op_num_threads = self._intra_op_threads
+        so.inter_op_num_threads = self.interOpThreads
+        so.graph_optimization_level = getattr(ort.GraphOptimizationLevel, _GRAPH_OPT_LEVELS[self.graphOptLevel])
+        so.execution_mode = getattr(ort.ExecutionMode, _EXECUTION_MODES[self.executionMode])
+        return so
+
+    def _make_session(self):
+        so = self._session_options()
+        if self._cached_model_path is None:
+            return ort.InferenceSession(self.modelPath, sess_options=so, providers=self._providers)
+
+        # Cache hit: the graph is already optimized, skip doing it again
+        if os.path.isfile(self._cached_model_path):
+            so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            try:
+                return ort.InferenceSession(self._cached_model_path, sess_options=so, providers=self._providers)
+            except Exception as e:
+                self._log.warning(f"Ignoring unreadable optimized model cache {self._cached_model_path}: {e}")
+                so = self._session_options()
+
+        # Cache miss: let ORT serialize the optimized graph, then publish it atomically
+        tmp_path = f"{self._cached_model_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        so.optimized_model_filepath = tmp_path
+        session = ort.InferenceSession(self.modelPath, sess_options=so, providers=self._providers)
+        try:
+            os.replace(tmp_path, self._cached_model_path)
+            self._log.info(f"Cached optimized model: {self._cached_model_path}")
+        except OSError as e:
+            self._log.warning(f"Failed to cache optimized model: {e}")
+        return session
+
+    def _make_engine(self):
+        session = self._make_session()
+        return _InferenceEngine(session, self.vectorLength, self.specWidth, self.embeddingLength, self.maxBatchSize, self._log, self._metrics)
+
+    def _infer_in_worker(self, rows):
+        engine = getattr(self._worker_state, "engine", None)
+        if engine is None:
+            engine = self._worker_state.engine = self._make_engine()
+        embeddings = np.empty((rows.shape[0], self.embeddingLength), dtype=np.float32)
+        kept = []
+        return embeddings[:engine.fingerprint(rows, embeddings, kept)], kept
+
+    def gate_stats(self):
+        return {"scored": self._gate_scored, "failed": self._gate_failed}
+
+    def stop(self):
+        if self.gateMetric != "OFF":
+            action = "dropped" if self.gateAction == "DROP" else "flagged"
+            self._log.info(f"Quality gate ({self.gateMetric} vs {self.gateThreshold}): {action} {self._gate_failed} of {self._gate_scored} vectors.")
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._inflight.clear()
+        return True
+
+    def forecast(self, noutput_items, ninputs):
+        # With vectors pending or in flight, run even without new input so they can be emitted
+        return [0 if (self._n_pending or self._inflight) else 1] * ninputs
+
+    def _dispatch_size(self, n, space):
+        """How many of n vectors can be dispatched now: no more than the output has room for."""
+        if self._pool is None:
+            return min(n, space)
+        return n if len(self._inflight) < self._max_inflight else 0
+
+    def _gate(self, rows, cfo=None):
+        """
+        Scores rows with the quality gate. Returns the rows to fingerprint, in FLAG
+        mode a per-row array holding the score of low-quality rows (NaN elsewhere),
+        and the CFOs of the rows kept.
+        """
+        if self.gateMetric == "OFF":
+            return rows, None, cfo
+
+        with self._metrics.time("gate"), np.errstate(divide="ignore", invalid="ignore"):
+            scores = preamble_quality(rows, self.gateMetric, self._gate_lag, self._gate_stf_len)
 
-    def work(self, input_items, output_items):
+        # PAPR is bad when high, the other metrics when low; NaN scores (silent frames) always fail
+        if self.gateMetric == "PAPR":
+            low = ~(scores <= self.gateThreshold)
+        else:
+            low = ~(scores >= self.gateThreshold)
+        self._gate_scored += rows.shape[0]
+        self._gate_failed += int(low.sum())
+        self._metrics.count("gated", int(low.sum()))
+
+        if self.gateAction == "DROP":
+            return rows[~low], None, None if cfo is None else cfo[~low]
+        return rows, np.where(low, scores, np.nan), cfo
+
+    def _tag_low_quality(self, produced, flags, kept):
+        if flags is None:
+            return
+        offset = self.nitems_written(0) + produced
+        for j, i in enumerate(kept):
+            if not np.isnan(flags[i]):
+                self.add_item_tag(0, offset + j, self._low_quality_key, pmt.from_double(float(flags[i])))
+
+    def _dispatch(self, rows, out_mat, produced, cfo=None, out_cfo=None):
+        rows, flags, cfo = self._gate(rows, cfo)
+        if rows.shape[0] == 0:
+            return produced
+
+        if self._pool is None:
+            kept = [] if flags is not None or cfo is not None else None
+            n = self._engine.fingerprint(rows, out_mat[produced:], kept)
+            self._tag_low_quality(produced, flags, kept)
+            if cfo is not None:
+                out_cfo[produced:produced + n] = cfo[kept]
+            return produced + n
+
+        # [future, low-quality flags, CFOs, embeddings of it already emitted]
+        cfo = None if cfo is None else cfo.copy()
+        self._inflight.append([self._pool.submit(self._infer_in_worker, rows.copy()), flags, cfo, 0])
+        return produced
+
+    def _collect(self, out_mat, produced, wait, out_cfo=None):
+        # Emit finished batches strictly in submission order, as much of each as fits
+        while self._inflight and produced < out_mat.shape[0]:
+            head, flags, cfo, emitted = self._inflight[0]
+            if not head.done():
+                if not wait:
+                    break
+                futures.wait([head], timeout=self._poll_s)
+                wait = False
+                continue
+
+            embeddings, kept = head.result()
+            n = min(embeddings.shape[0] - emitted, out_mat.shape[0] - produced)
+            out_mat[produced:produced + n] = embeddings[emitted:emitted + n]
+            self._tag_low_quality(produced, flags, kept[emitted:emitted + n])
+            if cfo is not None:
+                out_cfo[produced:produced + n] = cfo[kept[emitted:emitted + n]]
+            produced += n
+            if emitted + n < embeddings.shape[0]:
+                self._inflight[0][3] = emitted + n
+                break
+            self._inflight.popleft()
+        return produced
+
+    def general_work(self, input_items, output_items):
         in_mat = input_items[0]
         out_mat = output_items[0]
+        # CFO of every vector, passed through alongside the embedding made from it
+        in_cfo = input_items[1] if self.cfoInput else None
+        out_cfo = output_items[1] if self.cfoInput else None
+        n_in = min(in_mat.shape[0], in_cfo.shape[0]) if self.cfoInput else in_mat.shape[0]
 
         if in_mat.shape[1] != self.vectorLength:
+            self._metrics.count("errors")
             self._log.error(f"Incorrect input vector: received {in_mat.shape[1]}, expected {self.vectorLength}.")
             return 0
-        
-        produced = 0
-        for i in range(in_mat.shape[0]):
-            iq = in_mat[i].reshape(1, -1).astype(np.complex64)   
 
-            try:
-                spec = self._ch_ind_spec_generator.channel_ind_spectrogram(data=iq, row=self.specWidth, enable_ind=True)
-                spec = spec.astype(np.float32, copy=False)
-            except Exception as e:
-                self._log.error(f"Failed to produce a channel-independent spectrogram: {e}")
-                continue
+        produced = self._collect(out_mat, 0, wait=False, out_cfo=out_cfo)
+        consumed = 0
+        while True:
+            avail = n_in - consumed
+            space = out_mat.shape[0] - produced
 
-            try:
-                out = self._session.run([self._out_name], {self._in_name: spec})[0]
-                embedding = np.asarray(out).reshape(-1)
-            except Exception as e:
-                self._log.error(f"ONNX inference failed: {e}")
+            # Without a deadline, and for bursts of a full batch, skip the pending buffer
+            if self._n_pending == 0 and avail > 0 and (self._max_latency_s == 0 or avail >= self.maxBatchSize):
+                n = self._dispatch_size(min(avail, self.maxBatchSize), space)
+                if n == 0:
+                    break
+                cfo = in_cfo[consumed:consumed + n] if self.cfoInput else None
+                produced = self._dispatch(in_mat[consumed:consumed + n], out_mat, produced, cfo, out_cfo)
+                consumed += n
                 continue
 
-            if embedding.shape[0] != self.embeddingLength:
-                self._log.error(f"Model output has incorrect size: {embedding.shape}")
-            else:
-                out_mat[i, :] = embedding.astype(np.float32)
-            
-            produced += 1
+            if self._max_latency_s == 0:
+                break
+
+            take = min(avail, self.maxBatchSize - self._n_pending)
+            if take > 0:
+                if self._n_pending == 0:
+                    self._pending_since = time.monotonic()
+                self._pending[self._n_pending:self._n_pending + take] = in_mat[consumed:consumed + take]
+                if self.cfoInput:
+                    self._pending_cfo[self._n_pending:self._n_pending + take] = in_cfo[consumed:consumed + take]
+                self._n_pending += take
+                consumed += take
+
+            if self._n_pending == 0 or self._dispatch_size(self._n_pending, space) == 0:
+                break
+
+            waited = time.monotonic() - self._pending_since
+            if self._n_pending < self.maxBatchSize and waited < self._max_latency_s:
+                # Nothing new in this call: nap briefly, then let the scheduler refresh our input
+                if take == 0 and not self._inflight:
+                    time.sleep(min(self._poll_s, self._max_latency_s - waited))
+                break
+
+            # Flush what fits; the rest stays pending, still overdue, for the next call
+            n = self._dispatch_size(self._n_pending, space)
+            cfo = self._pending_cfo[:n] if self.cfoInput else None
+            produced = self._dispatch(self._pending[:n], out_mat, produced, cfo, out_cfo)
+            self._pending[:self._n_pending - n] = self._pending[n:self._n_pending]
+            self._pending_cfo[:self._n_pending - n] = self._pending_cfo[n:self._n_pending]
+            self._n_pending -= n
+
+        # Block on the oldest batch only when this call made no other progress
+        produced = self._collect(out_mat, produced, wait=(consumed == 0 and produced == 0), out_cfo=out_cfo)
+
+        self._metrics.count("frames", consumed)
+        self._metrics.count("embeddings", produced)
+        self._metrics.maybe_publish(self, self._metrics_port)
 
+        self.consume(0, consumed)
+        if self.cfoInput:
+            self.consume(1, consumed)
         return produced
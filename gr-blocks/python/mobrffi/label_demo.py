@@ -1,7 +1,9 @@
 import math
 import logging
+import pmt
 import numpy as np
 from gnuradio import gr
+from .metrics import BlockMetrics
 from PyQt5 import QtCore, QtGui, QtWidgets as QtW
 
 GREEN = "#35c46a"
@@ -129,10 +131,10 @@ class label_demo(gr.sync_block):
     Input : stream of int32 labels
             >=0 -> activate/show that label
             -1  -> clear all tiles (optional convenience)
-    Param : maxLabelCount (int)
+    Param : maxLabelCount (int), metricsInterval (s, 0 = off), metricsFile (Prometheus text file)
     GUI   : grid of tiles; first time a label is seen it is assigned to the first free tile.
     """
-    def __init__(self, maxLabelCount=8, parent=None):
+    def __init__(self, maxLabelCount=8, parent=None, metricsInterval=5.0, metricsFile=''):
         super().__init__(
             name="MobRFFI Label Demo",
             in_sig=[np.int32],  
@@ -158,6 +160,11 @@ class label_demo(gr.sync_block):
         
         self._last_label = None  
 
+        # Instrumentation, published on the "metrics" message port every metricsInterval seconds
+        self._metrics = BlockMetrics("label_demo", self.unique_id(), interval=metricsInterval, path=metricsFile, log=self._log)
+        self._metrics_port = pmt.intern("metrics")
+        self.message_port_register_out(self._metrics_port)
+
     def work(self, input_items, output_items):
         labels = input_items[0]
         
@@ -180,6 +187,10 @@ class label_demo(gr.sync_block):
                 self._log.info(f"Activating label {iv}")
                 self._widget.signal_set_active.emit(iv)
                 self._last_label = iv
+                self._metrics.count("label_changes")
+
+        self._metrics.count("frames", len(labels))
+        self._metrics.maybe_publish(self, self._metrics_port)
 
         return len(labels)
 
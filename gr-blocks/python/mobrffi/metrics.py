@@ -0,0 +1,177 @@
+"""
+Low-overhead per-block instrumentation shared by the mobrffi blocks: stage timers
+backed by rolling latency windows, event counters, gauges and frames/sec,
+published as a PMT dict on the block's "metrics" message port and optionally as
+a Prometheus text-format file (e.g. for node_exporter's textfile collector).
+"""
+import os
+import time
+import threading
+import pmt
+import numpy as np
+
+_QUANTILES = (50, 95, 99)
+
+class _LatencyWindow():
+    """Ring buffer of the most recent latencies of one stage, in seconds."""
+    def __init__(self, size):
+        self._buf = np.zeros(int(size), dtype=np.float64)
+        self._n = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        self._buf[self._n % self._buf.shape[0]] = seconds
+        self._n += 1
+        self.total += seconds
+
+    @property
+    def count(self):
+        return self._n
+
+    def quantiles(self):
+        n = min(self._n, self._buf.shape[0])
+        if n == 0:
+            return [float("nan")] * len(_QUANTILES)
+        return [float(q) for q in np.percentile(self._buf[:n], _QUANTILES)]
+
+class _StageTimer():
+    __slots__ = ("_metrics", "_stage", "_t0")
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.record(self._stage, time.perf_counter() - self._t0)
+        return False
+
+class BlockMetrics():
+    """
+    Stage latencies and event counters of one block instance. Safe to update from
+    worker threads; snapshots are only built when a publication is due.
+    """
+    def __init__(self, block, instance, interval=5.0, path="", log=None, window=4096):
+        self.block = str(block)
+        self.instance = str(instance)
+        self.interval = float(interval)
+        self.path = str(path).strip()
+        self._window = int(window)
+        self._log = log
+        self._stages = {}
+        self._counters = {"frames": 0, "errors": 0}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+        self._t_start = time.monotonic()
+        self._t_last = self._t_start
+        self._frames_last = 0
+
+        if self.interval < 0: raise ValueError("metricsInterval must be non-negative (0 disables metrics).")
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def time(self, stage):
+        return _StageTimer(self, stage)
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            window = self._stages.get(stage)
+            if window is None:
+                window = self._stages[stage] = _LatencyWindow(self._window)
+            window.record(seconds)
+
+    def count(self, event, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + n
+
+    def gauge(self, name, value):
+        """Sets a point-in-time value (e.g. a queue depth), exported as mobrffi_<name>."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[name] = float(value)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            stages = {
+                name: dict(zip(("p50_ms", "p95_ms", "p99_ms"), [q * 1e3 for q in w.quantiles()]), count=w.count, total_s=w.total)
+                for name, w in self._stages.items()
+            }
+
+        dt = now - self._t_last
+        fps = (counters["frames"] - self._frames_last) / dt if dt > 0 else 0.0
+        self._t_last = now
+        self._frames_last = counters["frames"]
+
+        return {
+            "block": self.block,
+            "instance": self.instance,
+            "uptime_s": now - self._t_start,
+            "fps": fps,
+            "counters": counters,
+            "gauges": gauges,
+            "stages": stages,
+        }
+
+    def to_prometheus(self, snap):
+        labels = f'block="{self.block}",instance="{self.instance}"'
+        lines = [
+            "# TYPE mobrffi_stage_latency_seconds summary",
+        ]
+        for stage, st in snap["stages"].items():
+            stage_labels = f'{labels},stage="{stage}"'
+            for q, key in zip(_QUANTILES, ("p50_ms", "p95_ms", "p99_ms")):
+                lines.append(f'mobrffi_stage_latency_seconds{{{stage_labels},quantile="{q / 100:g}"}} {st[key] / 1e3:.9g}')
+            lines.append(f"mobrffi_stage_latency_seconds_sum{{{stage_labels}}} {st['total_s']:.9g}")
+            lines.append(f"mobrffi_stage_latency_seconds_count{{{stage_labels}}} {st['count']}")
+        lines.append("# TYPE mobrffi_events_total counter")
+        for event, n in snap["counters"].items():
+            lines.append(f'mobrffi_events_total{{{labels},event="{event}"}} {n}')
+        lines.append("# TYPE mobrffi_frames_per_second gauge")
+        lines.append(f"mobrffi_frames_per_second{{{labels}}} {snap['fps']:.6g}")
+        for name, value in snap["gauges"].items():
+            lines.append(f"# TYPE mobrffi_{name} gauge")
+            lines.append(f"mobrffi_{name}{{{labels}}} {value:.9g}")
+        lines.append("# TYPE mobrffi_uptime_seconds gauge")
+        lines.append(f"mobrffi_uptime_seconds{{{labels}}} {snap['uptime_s']:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, snap):
+        # Write-then-rename so scrapers never read a partial file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus(snap))
+        os.replace(tmp_path, self.path)
+
+    def maybe_publish(self, block, port):
+        """
+        Publishes a snapshot on the block's message port (and to the Prometheus file)
+        once every `interval` seconds. Cheap to call from every work() invocation.
+        """
+        if not self.enabled or time.monotonic() - self._t_last < self.interval:
+            return None
+
+        snap = self.snapshot()
+        try:
+            block.message_port_pub(port, pmt.to_pmt(snap))
+            if self.path:
+                self.write_prometheus(snap)
+        except Exception as e:
+            if self._log is not None:
+                self._log.warning(f"Failed to publish metrics: {e}")
+        return snap
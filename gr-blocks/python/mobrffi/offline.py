@@ -0,0 +1,116 @@
+"""
+Offline helpers shared by the mobrffi command-line tools: reading host-receiver
+HDF5 captures (one transmitter per file), computing embeddings with the same
+spectrogram front-end as get_fingerprint, and scoring re-identification.
+"""
+import time
+import numpy as np
+from scipy import signal
+from fractions import Fraction
+
+try:
+    import h5py
+except Exception as e:
+    raise ImportError("h5py is required: `pip install h5py`")
+
+from .get_fingerprint import SpectrogramPlan
+
+def load_capture_iq(path, vector_length=400, capture_rate=20e6, sample_rate=25e6, max_frames=None):
+    """
+    Loads the preambles of one capture as an (N, vector_length) complex64 array,
+    resampled from capture_rate to the model's sample_rate like the live flowgraph.
+    """
+    with h5py.File(path, "r") as f:
+        iq = f["iq"][:max_frames] if max_frames else f["iq"][()]
+
+    # Captures are stored either as complex64 or as (N, M, 2) int16 I/Q pairs
+    if iq.ndim == 3:
+        iq = iq[..., 0].astype(np.float32) + 1j * iq[..., 1].astype(np.float32)
+    iq = iq.astype(np.complex64, copy=False)
+
+    if not np.isclose(capture_rate, sample_rate):
+        frac = Fraction(sample_rate / capture_rate).limit_denominator()
+        iq = signal.resample_poly(iq, frac.numerator, frac.denominator, axis=1)
+
+    out = np.zeros((iq.shape[0], int(vector_length)), dtype=np.complex64)
+    n = min(out.shape[1], iq.shape[1])
+    out[:, :n] = iq[:, :n]
+    return out
+
+def load_captures(paths, max_frames=None, **kwargs):
+    """
+    Loads several captures; returns (iq, labels, names) where labels index into names.
+    """
+    iqs, labels = [], []
+    for i, path in enumerate(paths):
+        iq = load_capture_iq(path, max_frames=max_frames, **kwargs)
+        iqs.append(iq)
+        labels.append(np.full(iq.shape[0], i, dtype=np.int32))
+    return np.concatenate(iqs), np.concatenate(labels), [str(p) for p in paths]
+
+def session_batch_size(session, batch_size):
+    """Largest usable batch for a session: 1 if the model has a fixed batch dimension."""
+    return batch_size if not isinstance(session.get_inputs()[0].shape[0], int) else 1
+
+def session_input_dtype(session):
+    """FP16 models exported without float32 I/O take float16 spectrograms."""
+    return np.float16 if session.get_inputs()[0].type == "tensor(float16)" else np.float32
+
+def compute_spectrograms(iq, spec_width=80, chunk_size=1024):
+    # One plan sized to a fixed chunk keeps the scratch buffers bounded for large captures
+    plan = SpectrogramPlan(iq.shape[1], spec_width, max_batch=chunk_size)
+    out = plan.empty(iq.shape[0])
+    for start in range(0, iq.shape[0], chunk_size):
+        stop = min(start + chunk_size, iq.shape[0])
+        plan.execute(iq[start:stop], out[start:stop])
+    return out
+
+def compute_embeddings(session, specs, batch_size=32):
+    in_name = session.get_inputs()[0].name
+    out_name = session.get_outputs()[0].name
+    batch_size = session_batch_size(session, batch_size)
+    specs = specs.astype(session_input_dtype(session), copy=False)
+
+    chunks = []
+    for start in range(0, specs.shape[0], batch_size):
+        out = session.run([out_name], {in_name: specs[start:start + batch_size]})[0]
+        chunks.append(np.asarray(out, dtype=np.float32).reshape(min(batch_size, specs.shape[0] - start), -1))
+    return np.concatenate(chunks)
+
+def l2_normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+def reid_accuracy(embeddings, labels, n_enroll=20):
+    """
+    Nearest-centroid re-identification: the first n_enroll frames of every device
+    form its gallery centroid, the remaining frames are classified by cosine similarity.
+    Returns (accuracy, predictions) over the query frames.
+    """
+    embeddings = l2_normalize(embeddings)
+    devices = np.unique(labels)
+
+    centroids, query_mask = [], np.zeros(labels.shape[0], dtype=bool)
+    for d in devices:
+        idx = np.flatnonzero(labels == d)
+        centroids.append(embeddings[idx[:n_enroll]].mean(axis=0))
+        query_mask[idx[n_enroll:]] = True
+
+    centroids = l2_normalize(np.stack(centroids))
+    predictions = devices[np.argmax(embeddings[query_mask] @ centroids.T, axis=1)]
+    accuracy = float(np.mean(predictions == labels[query_mask])) if query_mask.any() else float("nan")
+    return accuracy, predictions
+
+def batch_latency_ms(session, specs, batch_size=32, repeats=50):
+    """Median and p95 latency of one session.run over a batch of spectrograms, in ms."""
+    in_name = session.get_inputs()[0].name
+    out_name = session.get_outputs()[0].name
+    batch = specs[:session_batch_size(session, batch_size)].astype(session_input_dtype(session))
+
+    session.run([out_name], {in_name: batch})  # warm-up
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        session.run([out_name], {in_name: batch})
+        times.append((time.perf_counter() - t0) * 1e3)
+    return float(np.median(times)), float(np.percentile(times, 95))
@@ -0,0 +1,178 @@
+"""
+Write-behind persistence for the reid block: enrollments and evictions are queued
+in memory and flushed to a Chroma collection (or any store with Chroma's add() and
+delete() signatures) in batches by a background thread, so work() never blocks on
+the store.
+"""
+import time
+import threading
+import numpy as np
+
+def hnsw_metadata(m=16, construction_ef=100, search_ef=100):
+    """
+    Metadata of a cosine-distance Chroma collection with the given HNSW graph degree
+    (M) and candidate list sizes while building and searching. Larger values raise
+    recall at the cost of insert and query time; Chroma fixes all but search_ef when
+    the collection is created. The defaults are Chroma's own.
+    """
+    return {
+        "hnsw:space": "cosine",
+        "hnsw:M": int(m),
+        "hnsw:construction_ef": int(construction_ef),
+        "hnsw:search_ef": int(search_ef),
+    }
+
+class WriteBehindWriter():
+    """
+    Queues added (id, embedding, metadata) records and deleted ids, and flushes them
+    in order to `store.add` / `store.delete` when `batch_size` operations are waiting
+    or `flush_interval` seconds have passed since the oldest one was queued. Records
+    stay visible through pending() until the store has accepted them; failed flushes
+    are retried on the next trigger.
+    """
+    def __init__(self, store, dim, batch_size=256, flush_interval=0.5, log=None, metrics=None):
+        self._store = store
+        self.dim = int(dim)
+        self.batch_size = int(batch_size)
+        self.flush_interval = float(flush_interval)
+        self._log = log
+        self._metrics = metrics
+
+        if self.batch_size < 1: raise ValueError("persistBatchSize must be at least 1.")
+        if self.flush_interval <= 0.0: raise ValueError("persistFlushInterval must be positive.")
+
+        self._queue = []          # (op, id, embedding, metadata) not yet handed to the store
+        self._inflight = []       # operations of the flush currently in progress
+        self._t_oldest = None
+        self._cond = threading.Condition()
+        self._stopping = False
+
+        self._thread = threading.Thread(target=self._run, name="mobrffi-persist", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """Records accepted by submit() but not yet written to the store."""
+        with self._cond:
+            return len(self._queue) + len(self._inflight)
+
+    def _put(self, op):
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError("Write-behind writer is stopped.")
+            if not self._queue:
+                self._t_oldest = time.monotonic()
+            self._queue.append(op)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+
+    def submit(self, _id, embedding, metadata):
+        self._put(("add", str(_id), np.asarray(embedding, dtype=np.float32).ravel(), dict(metadata)))
+
+    def delete(self, _id):
+        self._put(("delete", str(_id), None, None))
+
+    def pending(self):
+        """
+        Snapshot of the operations not yet acknowledged by the store, as
+        (embeddings, labels, deleted ids) of the pending adds and deletes. Take it
+        before querying the store: a record flushed in between then shows up in
+        both, never in neither.
+        """
+        with self._cond:
+            ops = self._inflight + self._queue
+        deleted = {op[1] for op in ops if op[0] == "delete"}
+        records = [op for op in ops if op[0] == "add" and op[1] not in deleted]
+        if not records:
+            return np.empty((0, self.dim), dtype=np.float32), np.empty(0, dtype=np.int64), deleted
+        embeddings = np.stack([r[2] for r in records])
+        labels = np.array([int(r[3]["label"]) for r in records], dtype=np.int64)
+        return embeddings, labels, deleted
+
+    def _due(self):
+        if not self._queue:
+            return False
+        return (self._stopping or len(self._queue) >= self.batch_size
+                or time.monotonic() - self._t_oldest >= self.flush_interval)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    if self._stopping:
+                        return
+                    timeout = None if not self._queue else max(0.0, self.flush_interval - (time.monotonic() - self._t_oldest))
+                    self._cond.wait(timeout)
+                self._inflight = self._queue[:self.batch_size]
+                del self._queue[:self.batch_size]
+                self._t_oldest = time.monotonic() if self._queue else None
+
+            ok = self._flush(self._inflight)
+
+            with self._cond:
+                if not ok:
+                    # Put the batch back in front and back off for one interval
+                    self._queue[:0] = self._inflight
+                    self._t_oldest = time.monotonic()
+                self._inflight = []
+                self._cond.notify_all()
+                if not ok:
+                    if self._stopping:
+                        return
+                    self._cond.wait(self.flush_interval)
+
+    def _flush(self, ops):
+        done = 0
+        try:
+            t0 = time.perf_counter()
+            # One store call per run of consecutive operations of the same kind
+            while done < len(ops):
+                op = ops[done][0]
+                end = done
+                while end < len(ops) and ops[end][0] == op:
+                    end += 1
+                run = ops[done:end]
+                if op == "add":
+                    self._store.add(
+                        ids=[r[1] for r in run],
+                        embeddings=[r[2].tolist() for r in run],
+                        metadatas=[r[3] for r in run],
+                    )
+                else:
+                    self._store.delete(ids=[r[1] for r in run])
+                done = end
+            if self._metrics is not None:
+                self._metrics.record("persist", time.perf_counter() - t0)
+                self._metrics.count("persisted", len(ops))
+            return True
+        except Exception as e:
+            # Keep only what was not written yet, so a retry does not repeat operations
+            del ops[:done]
+            if self._metrics is not None:
+                self._metrics.count("errors")
+            if self._log is not None:
+                self._log.error(f"Persisting {len(ops)} gallery updates failed: {e}")
+            return False
+
+    def flush(self, timeout=None):
+        """Blocks until every queued record has been written (or `timeout` expires)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queue or self._inflight:
+                if self._queue:
+                    self._t_oldest = -float("inf")  # make the queue due right away
+                    self._cond.notify_all()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """Flushes what is pending and stops the thread; returns False if records were left."""
+        flushed = self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        return flushed
@@ -0,0 +1,67 @@
+"""
+Linear projections (PCA, optionally whitened) that shrink fingerprint embeddings
+before the reid block searches and stores them. Fitted offline by
+mobrffi_pca.py and saved as .npz.
+"""
+import numpy as np
+
+class Projection():
+    """
+    y = (x / |x| - mean) @ components.T, with the components already scaled when
+    whitening. Inputs are L2-normalized first, as when the projection was fitted.
+    """
+    def __init__(self, mean, components, explained=None, whiten=False):
+        self.mean = np.ascontiguousarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.explained = None if explained is None else np.asarray(explained, dtype=np.float64)
+        self.whiten = bool(whiten)
+
+        if self.components.ndim != 2 or self.mean.shape != (self.components.shape[1],):
+            raise ValueError("Projection mean must be (D,) and components (d, D).")
+
+    @property
+    def in_dim(self):
+        return self.components.shape[1]
+
+    @property
+    def dim(self):
+        return self.components.shape[0]
+
+    def apply(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        x = x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+        return (x - self.mean) @ self.components.T
+
+    def truncate(self, dim):
+        """The same projection keeping only the first `dim` components."""
+        explained = None if self.explained is None else self.explained[:dim]
+        return Projection(self.mean, self.components[:dim], explained, self.whiten)
+
+    def save(self, path):
+        np.savez(
+            path, mean=self.mean, components=self.components, whiten=self.whiten,
+            explained=self.explained if self.explained is not None else np.empty(0),
+        )
+
+def fit_pca(embeddings, dim, whiten=False, eps=1e-6):
+    """
+    Fits a PCA projection to (N, D) embeddings. Embeddings are L2-normalized first,
+    like everything reid compares. With `whiten`, every component is scaled to unit
+    variance.
+    """
+    x = np.asarray(embeddings, dtype=np.float64)
+    x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+    mean = x.mean(axis=0)
+    _, s, vt = np.linalg.svd(x - mean, full_matrices=False)
+
+    dim = min(int(dim), vt.shape[0])
+    variance = s ** 2 / max(1, x.shape[0] - 1)
+    components = vt[:dim]
+    if whiten:
+        components = components / np.sqrt(variance[:dim] + eps)[:, np.newaxis]
+    return Projection(mean, components, variance[:dim] / variance.sum(), whiten)
+
+def load_projection(path):
+    with np.load(path) as f:
+        explained = f["explained"] if f["explained"].size else None
+        return Projection(f["mean"], f["components"], explained, bool(f["whiten"]))
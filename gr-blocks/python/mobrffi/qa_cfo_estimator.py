@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import numpy as np
+from scipy import signal
+from fractions import Fraction
+from gnuradio import gr, gr_unittest
+try:
+    from gnuradio.mobrffi.cfo_estimator import cfo_estimator, _native_scale
+except ImportError:
+    import os
+    import sys
+    dirname, filename = os.path.split(os.path.abspath(__file__))
+    sys.path.append(os.path.join(dirname, "bindings"))
+    from gnuradio.mobrffi.cfo_estimator import cfo_estimator, _native_scale
+
+
+def reference_cfo(preamble, fs_in):
+    """Scalar per-frame estimator the vectorized one replaced: resample to 20 Msps, coarse then fine."""
+    fs_ref = 20e6
+    if not np.isclose(fs_in, fs_ref):
+        frac = Fraction(fs_ref / fs_in).limit_denominator()
+        preamble = signal.resample_poly(preamble, frac.numerator, frac.denominator)
+
+    def estimate(x, D):
+        return float(np.angle(np.vdot(x[:-D], x[D:])) * fs_ref / (2*np.pi*D))
+
+    coarse = estimate(preamble[12:12 + 144], 16)
+    n = np.arange(len(preamble), dtype=np.float64)
+    ltf = (preamble * np.exp(-1j * 2*np.pi * coarse * n / fs_ref))[160:320]
+    fine = estimate(ltf[24:24 + 128], 64)
+    return coarse + fine
+
+
+def synthetic_preambles(rng, n_frames, fs):
+    """L-STF/L-LTF shaped preambles (10 x 16 and 32 + 2 x 64 samples at 20 Msps) with a random CFO each."""
+    sym16 = rng.standard_normal((n_frames, 16)) + 1j * rng.standard_normal((n_frames, 16))
+    sym64 = rng.standard_normal((n_frames, 64)) + 1j * rng.standard_normal((n_frames, 64))
+    pre = np.concatenate([np.tile(sym16, 10), sym64[:, 32:], sym64, sym64], axis=1)
+    cfo = rng.uniform(-100e3, 100e3, n_frames)
+    pre = pre * np.exp(2j * np.pi * cfo[:, np.newaxis] * np.arange(pre.shape[1]) / 20e6)
+    pre += 0.05 * (rng.standard_normal(pre.shape) + 1j * rng.standard_normal(pre.shape))
+    frac = Fraction(fs / 20e6).limit_denominator()
+    pre = signal.resample_poly(pre, frac.numerator, frac.denominator, axis=1)
+    return pre.astype(np.complex64), cfo
+
+
+class qa_cfo_estimator(gr_unittest.TestCase):
+
+    def setUp(self):
+        self.tb = gr.top_block()
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        self.tb = None
+
+    def estimate(self, iq, fs, **kwargs):
+        block = cfo_estimator(vectorLength=iq.shape[1], sampleRate=fs, metricsInterval=0, **kwargs)
+        out = np.zeros(iq.shape[0], dtype=np.float32)
+        self.assertEqual(block.work([iq], [out]), iq.shape[0])
+        return block, out
+
+    def test_001_matches_scalar_reference(self):
+        for fs in (20e6, 25e6, 40e6):
+            iq, cfo = synthetic_preambles(self.rng, 64, fs)
+            block, out = self.estimate(iq, fs)
+            expected = np.array([reference_cfo(frame, fs) for frame in iq])
+            np.testing.assert_allclose(out, expected, rtol=0, atol=1.0)
+            np.testing.assert_allclose(out, cfo, rtol=0, atol=2e3)
+            # A single preamble goes through the same path as a block of them
+            self.assertAlmostEqual(block.extract_preamble_cfo(iq[0], fs_in=fs)[2], out[0], delta=1.0)
+
+    def test_002_resample_free_modes(self):
+        for fs, kwargs in ((25e6, dict(estimationMode="NATIVE")),
+                           (40e6, dict(estimationMode="NATIVE")),
+                           (40e6, dict(integerDecimation=True))):
+            iq, cfo = synthetic_preambles(self.rng, 64, fs)
+            _, out = self.estimate(iq, fs, **kwargs)
+            np.testing.assert_allclose(out, cfo, rtol=0, atol=2e3)
+
+    def test_003_native_scale(self):
+        self.assertAlmostEqual(_native_scale(25e6), 1.25)
+        self.assertAlmostEqual(_native_scale(40e6), 2.0)
+        for fs in (24e6, 21e6, 30.72e6):
+            with self.assertRaises(ValueError):
+                _native_scale(fs)
+        with self.assertRaises(ValueError):
+            cfo_estimator(vectorLength=400, sampleRate=24e6, estimationMode="NATIVE", metricsInterval=0)
+
+
+if __name__ == '__main__':
+    gr_unittest.run(qa_cfo_estimator)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import numpy as np
+from scipy import signal
+from gnuradio import gr, gr_unittest
+try:
+    from gnuradio.mobrffi.get_fingerprint import SpectrogramPlan
+except ImportError:
+    import os
+    import sys
+    dirname, filename = os.path.split(os.path.abspath(__file__))
+    sys.path.append(os.path.join(dirname, "bindings"))
+    from gnuradio.mobrffi.get_fingerprint import SpectrogramPlan
+
+GUARDS = list(range(0, 14)) + [40] + list(range(67, 80))
+
+
+def reference_spectrograms(data, row, enable_ind=True, overlap_coef=0.9, remove_subcarriers=True):
+    """Frame-by-frame scipy STFT formula SpectrogramPlan replaced."""
+    specs = []
+    for frame in data:
+        frame = frame / np.sqrt(np.mean(np.abs(frame)**2))
+        _, _, spec = signal.stft(frame, window='boxcar', nperseg=row, noverlap=row * overlap_coef,
+                                 nfft=row, return_onesided=False, padded=False, boundary=None)
+        spec = np.fft.fftshift(spec, axes=0)
+        if enable_ind:
+            spec = spec[:, 1:] / spec[:, :-1]
+        spec = np.log10(np.abs(spec)**2)
+        specs.append((spec - spec.mean()) / spec.std())
+    specs = np.stack(specs)[..., np.newaxis].astype(np.float32)
+    if remove_subcarriers:
+        specs = np.delete(specs, GUARDS, axis=1)
+    return specs
+
+
+class qa_get_fingerprint(gr_unittest.TestCase):
+
+    def setUp(self):
+        self.tb = gr.top_block()
+        rng = np.random.default_rng(0)
+        self.iq = (rng.standard_normal((37, 400)) + 1j * rng.standard_normal((37, 400))).astype(np.complex64)
+
+    def tearDown(self):
+        self.tb = None
+
+    def test_001_matches_reference(self):
+        for enable_ind in (True, False):
+            for remove_subcarriers in (True, False):
+                plan = SpectrogramPlan(400, 80, enable_ind=enable_ind, remove_subcarriers=remove_subcarriers, max_batch=8)
+                expected = reference_spectrograms(self.iq, 80, enable_ind, remove_subcarriers=remove_subcarriers)
+                result = plan.execute(self.iq)
+                self.assertEqual(result.shape, expected.shape)
+                np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-4)
+
+    def test_002_writes_into_out(self):
+        plan = SpectrogramPlan(400, 80)
+        out = plan.empty(self.iq.shape[0] + 3)
+        result = plan.execute(self.iq, out=out[3:])
+        self.assertTrue(np.shares_memory(result, out))
+        np.testing.assert_allclose(out[3:], reference_spectrograms(self.iq, 80), rtol=1e-4, atol=1e-4)
+
+    def test_003_rejects_wrong_length(self):
+        plan = SpectrogramPlan(400, 80)
+        with self.assertRaises(ValueError):
+            plan.execute(self.iq[:, :300])
+
+
+if __name__ == '__main__':
+    gr_unittest.run(qa_get_fingerprint)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+
+import numpy as np
+from gnuradio import gr, gr_unittest
+try:
+    from gnuradio.mobrffi.reid import reid
+except ImportError:
+    import os
+    import sys
+    dirname, filename = os.path.split(os.path.abspath(__file__))
+    sys.path.append(os.path.join(dirname, "bindings"))
+    from gnuradio.mobrffi.reid import reid
+
+D = 512
+
+
+class qa_reid(gr_unittest.TestCase):
+
+    def setUp(self):
+        self.tb = gr.top_block()
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((3, D))
+        # Eight frames of one device no one has seen, then two more devices interleaved
+        ids = np.array([0] * 8 + [1, 2, 1, 2, 0, 1, 2, 2])
+        self.frames = (centers[ids] + 0.2 * rng.standard_normal((len(ids), D))).astype(np.float32)
+
+    def tearDown(self):
+        self.tb = None
+
+    def run_block(self, chunk, **kwargs):
+        block = reid(embeddingLength=D, chromaPath='', cosineThreshold=0.2, metricsInterval=0, **kwargs)
+        out = np.zeros(self.frames.shape[0], dtype=np.int32)
+        for start in range(0, self.frames.shape[0], chunk):
+            stop = min(start + chunk, self.frames.shape[0])
+            self.assertEqual(block.work([self.frames[start:stop]], [out[start:stop]]), stop - start)
+        prototypes = np.array(block._gallery.embeddings, copy=True)
+        block.stop()
+        return out, prototypes
+
+    def test_001_batch_matches_frame_by_frame(self):
+        for kwargs in (dict(), dict(galleryMode='MEAN'), dict(galleryMode='EMA', emaAlpha=0.3)):
+            per_frame, per_frame_protos = self.run_block(1, **kwargs)
+            batched, batched_protos = self.run_block(self.frames.shape[0], **kwargs)
+            # The new device's frames share one label whether they arrive together or not
+            self.assertEqual(len(set(per_frame[:8].tolist())), 1)
+            self.assertEqual(len(set(per_frame.tolist())), 3)
+            np.testing.assert_array_equal(batched, per_frame)
+            np.testing.assert_allclose(batched_protos, per_frame_protos, rtol=1e-5, atol=1e-6)
+
+
+if __name__ == '__main__':
+    gr_unittest.run(qa_reid)
@@ -1,14 +1,107 @@
 import os
 import time
 import logging
+import pmt
+from collections import OrderedDict
 import numpy as np
 from gnuradio import gr
+from .metrics import BlockMetrics
+from .gallery import EmbeddingGallery, CompressedGallery, IVFGallery, CfoIndex, LABEL_TABLE_DTYPE, l2_normalize, save_snapshot, load_snapshot
+from .persistence import WriteBehindWriter, hnsw_metadata
+from .projection import load_projection
 
+# Chroma is only needed for the CHROMA query backend or for persistence
 try:
     import chromadb
     from chromadb.config import Settings
 except Exception as e:
-    raise ImportError("chromadb is required: `pip install chromadb`")
+    chromadb = None
+
+class _TouchedDevices():
+    """
+    Current vectors and CFO of the devices enrolled or updated earlier in a batch,
+    stacked in buffers that grow geometrically, so adding a device is cheap.
+    Devices evicted earlier in the batch are dropped: they still count as touched,
+    so stale search results naming them are skipped, but are never matched.
+    """
+    def __init__(self, dim, capacity=64):
+        self._dropped = set()
+        self._vecs_of = {}
+        self._cfo_of = {}
+        self._offsets = {}
+        self._labels = np.empty(capacity, dtype=np.int64)
+        self._vecs = np.empty((capacity, dim), dtype=np.float32)
+        self._cfo = np.empty(capacity, dtype=np.float64)
+        self._n = 0
+
+    def __len__(self):
+        return len(self._vecs_of)
+
+    def __contains__(self, label):
+        return label in self._vecs_of or label in self._dropped
+
+    def keys(self):
+        return self._vecs_of.keys()
+
+    def evicted(self, label):
+        return label in self._dropped
+
+    @property
+    def size(self):
+        """Touched devices, evicted ones included."""
+        return len(self._vecs_of) + len(self._dropped)
+
+    def set(self, label, vecs, cfo=float("nan")):
+        old = self._vecs_of.get(label)
+        self._vecs_of[label], self._cfo_of[label] = vecs, cfo
+        if old is not None and old.shape == vecs.shape:
+            start = self._offsets[label]
+            self._vecs[start:start + vecs.shape[0]] = vecs
+            self._cfo[start:start + vecs.shape[0]] = cfo
+        elif old is not None:
+            # The device's number of vectors changed; restack everything in order
+            self._restack()
+        else:
+            self._append(label, vecs, cfo)
+
+    def drop(self, label):
+        self._dropped.add(label)
+        if self._vecs_of.pop(label, None) is not None:
+            self._cfo_of.pop(label)
+            self._offsets.pop(label)
+            self._restack()
+
+    def _restack(self):
+        self._n = 0
+        for l, v in self._vecs_of.items():
+            self._append(l, v, self._cfo_of[l])
+
+    def _append(self, label, vecs, cfo):
+        stop = self._n + vecs.shape[0]
+        if stop > self._labels.shape[0]:
+            capacity = max(stop, 2 * self._labels.shape[0])
+            self._labels = np.resize(self._labels, capacity)
+            self._cfo = np.resize(self._cfo, capacity)
+            grown = np.empty((capacity, self._vecs.shape[1]), dtype=np.float32)
+            grown[:self._n] = self._vecs[:self._n]
+            self._vecs = grown
+        self._offsets[label] = self._n
+        self._labels[self._n:stop] = label
+        self._vecs[self._n:stop] = vecs
+        self._cfo[self._n:stop] = cfo
+        self._n = stop
+
+    def nearest(self, query, cfo=None, width=0.0):
+        """(label, distance) of the nearest vector, among those within `width` Hz of `cfo` if given."""
+        labels, vecs = self._labels[:self._n], self._vecs[:self._n]
+        if cfo is not None:
+            near = np.flatnonzero(np.abs(self._cfo[:self._n] - cfo) <= width)
+            labels, vecs = labels[near], vecs[near]
+        if labels.shape[0] == 0:
+            return -1, float("inf")
+        sims = vecs @ query
+        j = int(np.argmax(sims))
+        return int(labels[j]), float(1.0 - sims[j])
 
 class reid(gr.sync_block):
     """
@@ -18,19 +111,75 @@ class reid(gr.sync_block):
                  embeddingLength=768,
                  chromaPath="/tmp/mobrffi_chroma",
                  collectionName="mobrffi",
-                 cosineThreshold=0.1):
+                 cosineThreshold=0.1,
+                 metricsInterval=5.0,
+                 metricsFile='',
+                 queryBackend='MEMORY',
+                 persistBatchSize=256,
+                 persistFlushInterval=0.5,
+                 resume=False,
+                 snapshotPath='',
+                 snapshotDtype='float32',
+                 galleryMode='FIRST',
+                 emaAlpha=0.1,
+                 exemplarCount=0,
+                 deviceTtl=0.0,
+                 maxDevices=0,
+                 permanentHits=0,
+                 hotSize=0,
+                 hotMargin=0.5,
+                 galleryStorage='FLOAT32',
+                 pqSubspaces=64,
+                 rerankDepth=32,
+                 galleryStoreDir='',
+                 projectionPath='',
+                 galleryIndex='FLAT',
+                 ivfLists=0,
+                 ivfProbe=8,
+                 hnswM=16,
+                 hnswConstructionEf=100,
+                 hnswSearchEf=100,
+                 cfoInput=False,
+                 cfoWindow=2000.0,
+                 cfoAlpha=0.1):
         gr.sync_block.__init__(
             self,
             name="MobRFFI Classifier",
-            in_sig=[(np.float32, int(embeddingLength))],
+            in_sig=[(np.float32, int(embeddingLength))] + ([np.float32] if cfoInput else []),
             out_sig=[np.int32],
         )
 
         # Parameters
         self.embeddingLength = int(embeddingLength)
-        self.chromaPath = str(chromaPath)
+        self.chromaPath = str(chromaPath).strip()
         self.collectionName = str(collectionName)
         self.threshold = float(cosineThreshold)
+        self.queryBackend = str(queryBackend).upper().strip()
+        self.resume = bool(resume)
+        self.snapshotPath = str(snapshotPath).strip()
+        self.snapshotDtype = str(snapshotDtype).lower().strip()
+        self.galleryMode = str(galleryMode).upper().strip()
+        self.emaAlpha = float(emaAlpha)
+        self.exemplarCount = int(exemplarCount)
+        self.deviceTtl = float(deviceTtl)
+        self.maxDevices = int(maxDevices)
+        self.permanentHits = int(permanentHits)
+        self.hotSize = int(hotSize)
+        self.hotMargin = float(hotMargin)
+        self.galleryStorage = str(galleryStorage).upper().strip()
+        self.pqSubspaces = int(pqSubspaces)
+        self.rerankDepth = int(rerankDepth)
+        self.galleryStoreDir = str(galleryStoreDir).strip()
+        self.projectionPath = str(projectionPath).strip()
+        self.galleryIndex = str(galleryIndex).upper().strip()
+        self.ivfLists = int(ivfLists)
+        self.ivfProbe = int(ivfProbe)
+        self.hnswM = int(hnswM)
+        self.hnswConstructionEf = int(hnswConstructionEf)
+        self.hnswSearchEf = int(hnswSearchEf)
+        self.cfoInput = bool(cfoInput)
+        self.cfoWindow = float(cfoWindow)
+        self.cfoAlpha = float(cfoAlpha)
 
         # Logging
         self._log = logging.getLogger("mobrffi.reid")
@@ -42,32 +191,267 @@ class reid(gr.sync_block):
 
         # Validation
         if self.embeddingLength < 512: raise ValueError("embeddingLength must be at least 512 values long.")
+
+        # Optional linear projection (see mobrffi_pca.py); the gallery is searched and
+        # stored at the projected dimension
+        self._projection = load_projection(self.projectionPath) if self.projectionPath else None
+        if self._projection is not None and self._projection.in_dim != self.embeddingLength:
+            raise ValueError(f"Projection expects {self._projection.in_dim}-value embeddings, but embeddingLength is {self.embeddingLength}.")
+        self._dim = self._projection.dim if self._projection is not None else self.embeddingLength
         if self.threshold < 0.0: raise ValueError("cosineThreshold must be non-negative.")
-        if not self.chromaPath: raise ValueError("chromaPath must be a valid directory path.")
+        if self.queryBackend not in ("MEMORY", "CHROMA"): raise ValueError("queryBackend must be either MEMORY or CHROMA.")
+        if self.queryBackend == "CHROMA" and not self.chromaPath: raise ValueError("chromaPath must be a valid directory path.")
+        if self.chromaPath and chromadb is None: raise ImportError("chromadb is required: `pip install chromadb`")
+        if self.snapshotDtype not in ("float32", "float16"): raise ValueError("snapshotDtype must be either float32 or float16.")
+        if self.galleryMode not in ("FIRST", "MEAN", "EMA"): raise ValueError("galleryMode must be one of FIRST, MEAN or EMA.")
+        if not 0.0 < self.emaAlpha <= 1.0: raise ValueError("emaAlpha must be in (0, 1].")
+        if self.exemplarCount < 0: raise ValueError("exemplarCount must be non-negative.")
+        if self.deviceTtl < 0.0: raise ValueError("deviceTtl must be non-negative (0 disables expiry).")
+        if self.maxDevices < 0: raise ValueError("maxDevices must be non-negative (0 means unlimited).")
+        if self.permanentHits < 0: raise ValueError("permanentHits must be non-negative (0 means no device is permanent).")
+        if self.hotSize < 0: raise ValueError("hotSize must be non-negative (0 disables the hot set).")
+        if not 0.0 < self.hotMargin <= 1.0: raise ValueError("hotMargin must be in (0, 1].")
+        if self.galleryStorage not in ("FLOAT32", "FLOAT16", "PQ"): raise ValueError("galleryStorage must be one of FLOAT32, FLOAT16 or PQ.")
+        if self.galleryStorage == "PQ" and (self.pqSubspaces < 1 or self._dim % self.pqSubspaces): raise ValueError("pqSubspaces must divide the (projected) embedding length.")
+        if self.rerankDepth < 1: raise ValueError("rerankDepth must be at least 1.")
+        if self.galleryIndex not in ("FLAT", "IVF"): raise ValueError("galleryIndex must be either FLAT or IVF.")
+        if self.galleryIndex == "IVF" and self.galleryStorage != "FLOAT32": raise ValueError("The IVF index needs FLOAT32 gallery storage.")
+        if self.ivfLists < 0: raise ValueError("ivfLists must be non-negative (0 picks 4 * sqrt(N)).")
+        if self.ivfProbe < 1: raise ValueError("ivfProbe must be at least 1.")
+        if self.hnswM < 2: raise ValueError("hnswM must be at least 2.")
+        if self.hnswConstructionEf < 1 or self.hnswSearchEf < 1: raise ValueError("hnswConstructionEf and hnswSearchEf must be at least 1.")
+        if (self.galleryMode != "FIRST" or self.exemplarCount) and self.queryBackend != "MEMORY": raise ValueError("Prototypes and exemplars need the MEMORY query backend.")
+        if self.cfoInput and self.queryBackend != "MEMORY": raise ValueError("CFO-partitioned search needs the MEMORY query backend.")
+        if self.cfoWindow <= 0.0: raise ValueError("cfoWindow must be positive.")
+        if not 0.0 < self.cfoAlpha <= 1.0: raise ValueError("cfoAlpha must be in (0, 1].")
+        if self.resume and not (self.snapshotPath or self.chromaPath): raise ValueError("resume needs a snapshotPath or a chromaPath to resume from.")
 
-        os.makedirs(self.chromaPath, exist_ok=True)
+        # Instrumentation, published on the "metrics" message port every metricsInterval seconds
+        self._metrics = BlockMetrics("reid", self.unique_id(), interval=metricsInterval, path=metricsFile, log=self._log)
+        self._metrics_port = pmt.intern("metrics")
+        self.message_port_register_out(self._metrics_port)
 
-        # Create client and fresh collection in Chroma (purge if exists)
-        self._chroma = chromadb.PersistentClient(
-            path=self.chromaPath,
-            settings=Settings(allow_reset=True),
-        )
+        # Chroma is the query path for the CHROMA backend, and optional persistence otherwise
+        self._db_collection = None
+        self._writer = None
+        if self.chromaPath:
+            os.makedirs(self.chromaPath, exist_ok=True)
 
-        try:
-            self._chroma.delete_collection(self.collectionName)
-        except Exception:
-            pass
-
-        # Create a new collection to store cosine distances
-        self._db_collection = self._chroma.create_collection(
-            name=self.collectionName,
-            metadata={"hnsw:space": "cosine"}
-        )
-        self._log.info(f"Chroma collection created: {self.collectionName}. Path: {self.chromaPath}")
+            # Create client and fresh collection in Chroma (purge if exists, unless resuming)
+            self._chroma = chromadb.PersistentClient(
+                path=self.chromaPath,
+                settings=Settings(allow_reset=True),
+            )
+
+            # HNSW index parameters; an existing collection keeps the ones it was created with
+            hnsw = hnsw_metadata(self.hnswM, self.hnswConstructionEf, self.hnswSearchEf)
+            if self.resume:
+                self._db_collection = self._chroma.get_or_create_collection(
+                    name=self.collectionName,
+                    metadata=hnsw
+                )
+                self._log.info(f"Chroma collection opened: {self.collectionName}. Path: {self.chromaPath}")
+                current = self._db_collection.metadata or {}
+                changed = [k for k, v in hnsw.items() if k in current and current[k] != v]
+                if changed:
+                    self._log.warning(f"Resumed collection was created with different {', '.join(changed)}; keeping its values.")
+            else:
+                try:
+                    self._chroma.delete_collection(self.collectionName)
+                except Exception:
+                    pass
 
-        # Create a device label registry
+                # Create a new collection to store cosine distances
+                self._db_collection = self._chroma.create_collection(
+                    name=self.collectionName,
+                    metadata=hnsw
+                )
+                self._log.info(f"Chroma collection created: {self.collectionName}. Path: {self.chromaPath}")
+
+            # Enrollments are written to Chroma in batches by a background thread
+            self._writer = WriteBehindWriter(
+                self._db_collection, self._dim,
+                batch_size=persistBatchSize, flush_interval=persistFlushInterval,
+                log=self._log, metrics=self._metrics,
+            )
+
+        # In-memory gallery answering every batch of queries with one matrix multiply.
+        # It holds one prototype per device: the first embedding seen (FIRST), or a
+        # running mean / EMA of every confident match; optionally backed by a reservoir
+        # of up to exemplarCount exemplars per device that are matched as well
+        self._gallery = self._new_gallery()
+        self._exemplars = self._new_gallery()
+        self._exemplar_rows = {}
+        self._sum_norms = {}
+        self._rng = np.random.default_rng()
+        self._prototypes = self.galleryMode != "FIRST" or self.exemplarCount > 0
+
+        # Create a device label registry; devices imported from a snapshot keep their
+        # statistics in the (read-only) snapshot table until they are seen again
         self._device_labels = {}
+        self._label_base = None
         self._next_label = 101
+        self._n_devices = 0
+
+        # Evictable devices, least recently matched first. Devices matched at least
+        # permanentHits times leave the queue and are never evicted
+        self._evicting = self.deviceTtl > 0 or self.maxDevices > 0
+        self._lru = OrderedDict()
+
+        # Hot set: normalized vectors of the hotSize most recently matched devices
+        self._hot = OrderedDict()
+        self._hot_queries = 0
+        self._hot_hits = 0
+        self._chroma_vectors = {}
+        self._chroma_pending = None
+
+        # Running CFO of every device, sorted; with a CFO input, frames are only
+        # scored against devices within cfoWindow Hz of their own CFO. The input is
+        # paired with the embeddings by position, so it must come from get_fingerprint's
+        # CFO pass-through, which drops a frame's CFO whenever it drops the frame
+        self._cfo_index = CfoIndex()
+
+        if self.resume:
+            self._resume()
+
+    def _new_gallery(self):
+        if self.queryBackend != "MEMORY":
+            return EmbeddingGallery(self._dim)
+        # The IVF index scans only the ivfProbe cells nearest to each query, and is
+        # (re)trained in the background as the gallery grows
+        if self.galleryIndex == "IVF":
+            return IVFGallery(self._dim, nlist=self.ivfLists, nprobe=self.ivfProbe)
+        if self.galleryStorage == "FLOAT32":
+            return EmbeddingGallery(self._dim)
+        # Compressed storage keeps full-precision rows in a temporary file under galleryStoreDir
+        return CompressedGallery(
+            self._dim, storage=self.galleryStorage, subspaces=self.pqSubspaces,
+            rerank=self.rerankDepth, store_dir=self.galleryStoreDir,
+        )
+
+    def _resume(self):
+        t0 = time.perf_counter()
+        snap = load_snapshot(self.snapshotPath) if self.snapshotPath else None
+        stored = self._db_collection.count() if self._db_collection is not None else 0
+
+        if snap is not None and snap[2]["rows"] >= stored:
+            rows, source = self._import(snap), f"snapshot {self.snapshotPath}"
+        elif stored:
+            if snap is not None:
+                self._log.warning(f"Gallery snapshot is older than Chroma ({snap[2]['rows']} vs {stored} devices); loading from Chroma.")
+            self._load_from_chroma()
+            rows, source = stored, f"Chroma collection {self.collectionName}"
+        else:
+            self._log.info("Nothing to resume from; starting with an empty gallery.")
+            return
+
+        self._log.info(f"Resumed {rows} devices from {source} in {(time.perf_counter() - t0) * 1e3:.1f} ms; next label: {self._next_label}")
+
+    def _import(self, snap):
+        embeddings, table, meta = snap
+        if meta["dim"] != self._dim:
+            raise ValueError(f"Gallery snapshot holds {meta['dim']}-value embeddings, but the gallery expects {self._dim}.")
+
+        # Memory-mapped as is; pages are only read when the first query touches them
+        if self.queryBackend == "MEMORY":
+            self._gallery.attach(embeddings, table["label"])
+        labels = table["label"]
+        self._label_base = table if labels.shape[0] < 2 or np.all(labels[1:] > labels[:-1]) else np.sort(table, order="label")
+        self._next_label = max(self._next_label, int(meta["next_label"]))
+        self._n_devices = int(meta["rows"])
+
+        if self._evicting:
+            # Never-matched imports (NaN) are the first candidates
+            order = np.argsort(np.nan_to_num(table["last_update"], nan=0.0), kind="stable")
+            for label, last_update, count in zip(labels[order].tolist(), table["last_update"][order].tolist(), table["count"][order].tolist()):
+                self._touch(label, last_update, count)
+        return meta["rows"]
+
+    def import_snapshot(self, path):
+        """
+        Replaces the gallery with the snapshot in directory `path` (see export_snapshot).
+        Several flowgraphs can import the same snapshot; it is shared read-only.
+        """
+        snap = load_snapshot(path)
+        if snap is None: raise ValueError(f"No gallery snapshot in {path}.")
+        self._gallery = self._new_gallery()
+        self._exemplars = self._new_gallery()
+        self._exemplar_rows = {}
+        self._sum_norms = {}
+        self._device_labels = {}
+        self._lru = OrderedDict()
+        self._hot = OrderedDict()
+        self._cfo_index = CfoIndex()
+        rows = self._import(snap)
+        self._log.info(f"Imported {rows} devices from gallery snapshot {path}")
+        return rows
+
+    def export_snapshot(self, path=None, dtype=None):
+        """
+        Atomically writes the gallery and per-device label table to directory `path`
+        (default: snapshotPath) as memory-mappable .npy files.
+        """
+        path = path or self.snapshotPath
+        if not path: raise ValueError("No snapshot path given.")
+        if self.queryBackend != "MEMORY": raise ValueError("Gallery snapshots need the MEMORY query backend.")
+        save_snapshot(path, self._gallery.embeddings, self._label_table(), self._next_label, dtype=dtype or self.snapshotDtype)
+        return len(self._gallery)
+
+    def _label_table(self):
+        labels = np.asarray(self._gallery.labels)
+        table = np.zeros(labels.shape[0], dtype=LABEL_TABLE_DTYPE)
+        table["label"] = labels
+        table["enrolled_at"] = table["last_update"] = np.nan
+
+        if self._label_base is not None and self._label_base.shape[0]:
+            base_labels = self._label_base["label"]
+            idx = np.minimum(np.searchsorted(base_labels, labels), base_labels.shape[0] - 1)
+            hit = base_labels[idx] == labels
+            table[hit] = self._label_base[idx[hit]]
+
+        if self._device_labels:
+            order = np.argsort(labels, kind="stable")
+            seen = np.fromiter(self._device_labels.keys(), dtype=np.int64, count=len(self._device_labels))
+            pos = np.minimum(np.searchsorted(labels[order], seen), labels.shape[0] - 1)
+            for label, row in zip(seen.tolist(), order[pos].tolist()):
+                if labels[row] != label:
+                    continue
+                info = self._device_labels[label]
+                table[row] = (label, info.get("enrolled_at", np.nan), info["last_update"], info["count"])
+        return table
+
+    def _label_info(self, label):
+        label_info = self._device_labels.get(label)
+        if label_info is None and self._label_base is not None and self._label_base.shape[0]:
+            base_labels = self._label_base["label"]
+            i = int(np.searchsorted(base_labels, label))
+            if i < base_labels.shape[0] and base_labels[i] == label:
+                row = self._label_base[i]
+                label_info = self._device_labels[label] = {
+                    "enrolled_at": float(row["enrolled_at"]),
+                    "last_update": float(row["last_update"]),
+                    "count": int(row["count"]),
+                }
+        return label_info
+
+    def _load_from_chroma(self, page=4096):
+        # Slow path, used when no (up to date) snapshot exists
+        include = ["metadatas", "embeddings"] if self.queryBackend == "MEMORY" else ["metadatas"]
+        for offset in range(0, self._db_collection.count(), page):
+            res = self._db_collection.get(limit=page, offset=offset, include=include)
+            labels = np.array([
+                int(m["label"]) if m and "label" in m else int(_id)
+                for _id, m in zip(res["ids"], res["metadatas"])
+            ], dtype=np.int64)
+            if labels.size == 0:
+                break
+            if self.queryBackend == "MEMORY":
+                self._gallery.add(np.asarray(res["embeddings"], dtype=np.float32), labels)
+            self._next_label = max(self._next_label, int(labels.max()) + 1)
+            self._n_devices += labels.size
+            if self._evicting:
+                for label, m in zip(labels.tolist(), res["metadatas"]):
+                    self._touch(label, float((m or {}).get("enrolled_at", 0.0)), 1)
 
     def _enroll(self, embedding):
         label = self._next_label
@@ -75,80 +459,502 @@ class reid(gr.sync_block):
 
         _id = str(label)
         now = time.time()
-        self._db_collection.add(
-            ids=[_id],
-            embeddings=[embedding.astype(np.float32).tolist()],
-            metadatas=[{"label": label, "enrolled_at": now}]
-        )
-        self._device_labels[label] = {"last_update": now, "count": 1}
+        with self._metrics.time("enroll"):
+            if self.queryBackend == "MEMORY":
+                self._gallery.add(embedding, label)
+                if self.exemplarCount:
+                    self._exemplar_rows[label] = [int(self._exemplars.add(embedding, label)[0])]
+            if self._writer is not None:
+                self._writer.submit(_id, embedding, {"label": label, "enrolled_at": now})
+        self._metrics.count("enrolled")
+        self._device_labels[label] = {"enrolled_at": now, "last_update": now, "count": 1}
+        self._n_devices += 1
+        self._touch(label, now, 1)
         self._log.info(f"Enrolled new device; assigned label: {label}")
         return label
-    
+
+    def stop(self):
+        if self.snapshotPath and self.queryBackend == "MEMORY":
+            try:
+                rows = self.export_snapshot()
+                self._log.info(f"Saved {rows} devices to gallery snapshot {self.snapshotPath}")
+            except Exception as e:
+                self._log.error(f"Failed to save gallery snapshot: {e}")
+        if self._writer is not None:
+            depth = self._writer.depth
+            if not self._writer.stop(timeout=30.0):
+                self._log.error(f"Chroma persistence did not finish; {self._writer.depth} enrollments were not written.")
+            elif depth:
+                self._log.info(f"Flushed {depth} pending enrollments to Chroma.")
+        return True
+
     def _update_label_stats(self, label):
-        label_info = self._device_labels.get(label)
+        label_info = self._label_info(label)
         if label_info is None:
-            self._device_labels[label] = {"last_update": time.time(), "count": 1}
+            # Resumed from Chroma, which keeps no statistics: its enrollment plus this match
+            self._device_labels[label] = {"enrolled_at": np.nan, "last_update": time.time(), "count": 2}
         else:
             label_info["last_update"] = time.time()
             label_info["count"] = label_info.get("count", 0) + 1
+        label_info = self._device_labels[label]
+        self._touch(label, label_info["last_update"], label_info["count"])
+        return label_info["count"]
+
+    def _touch(self, label, last_update, count):
+        if not self._evicting:
+            return
+        if self.permanentHits and count >= self.permanentHits:
+            self._lru.pop(label, None)
+        else:
+            self._lru[label] = last_update
+            self._lru.move_to_end(label)
+
+    def _evict(self, expire=True):
+        """
+        Expires devices not matched for deviceTtl seconds and trims the gallery to
+        maxDevices, least recently matched first; returns the evicted labels. Only the
+        head of the LRU queue is inspected, so the cost is proportional to the number
+        of evicted devices.
+        """
+        if not self._lru:
+            return []
+        victims = []
+        if expire and self.deviceTtl > 0:
+            cutoff = time.time() - self.deviceTtl
+            while self._lru and next(iter(self._lru.values())) < cutoff:
+                victims.append(self._lru.popitem(last=False)[0])
+        if self.maxDevices > 0:
+            excess = self._n_devices - len(victims) - self.maxDevices
+            while excess > 0 and self._lru:
+                victims.append(self._lru.popitem(last=False)[0])
+                excess -= 1
+        if victims:
+            self._remove_devices(victims)
+        return victims
+
+    def _remove_devices(self, labels):
+        with self._metrics.time("evict"):
+            if self.queryBackend == "MEMORY":
+                rows = [self._gallery.row_of(label) for label in labels]
+                self._gallery.remove_rows([row for row in rows if row >= 0])
+                if self.exemplarCount:
+                    ex_rows = [row for label in labels for row in self._exemplar_rows.pop(label, [])]
+                    for old, new in self._exemplars.remove_rows(ex_rows).items():
+                        rows = self._exemplar_rows[int(self._exemplars.labels[new])]
+                        rows[rows.index(old)] = new
+            for label in labels:
+                self._device_labels.pop(label, None)
+                self._sum_norms.pop(label, None)
+                self._hot.pop(label, None)
+                self._cfo_index.remove(label)
+                if self._writer is not None:
+                    self._writer.delete(str(label))
+        self._n_devices -= len(labels)
+        self._metrics.count("evicted", len(labels))
+        self._log.info(f"Evicted {len(labels)} stale devices; {self._n_devices} remain.")
+
+    def _observe(self, label, query, count):
+        """Folds a confident match into the device's prototype and exemplar reservoir."""
+        row = self._gallery.row_of(label)
+        if row < 0:
+            return
+
+        if self.galleryMode == "MEAN":
+            # The prototype is the direction of the sum of the `count` normalized observations.
+            # Only the sum's norm is kept; devices without one (freshly enrolled, or resumed
+            # from a snapshot) start from count - 1, as if their observations were aligned
+            total = self._gallery.embeddings[row] * self._sum_norms.get(label, float(count - 1)) + query
+            self._sum_norms[label] = float(np.linalg.norm(total))
+            self._gallery.update(row, total)
+        elif self.galleryMode == "EMA":
+            self._gallery.update(row, (1.0 - self.emaAlpha) * self._gallery.embeddings[row] + self.emaAlpha * query)
+
+        if self.exemplarCount:
+            # Reservoir sampling keeps a uniform sample of all observations of the device
+            rows = self._exemplar_rows.setdefault(label, [])
+            if len(rows) < self.exemplarCount:
+                rows.append(int(self._exemplars.add(query, label)[0]))
+            else:
+                j = int(self._rng.integers(count))
+                if j < self.exemplarCount:
+                    self._exemplars.update(rows[j], query)
+
+    def _label_vectors(self, label):
+        """Current gallery vectors (prototype and exemplars) of one device."""
+        rows = [self._gallery.row_of(label)]
+        vecs = [self._gallery.embeddings[rows]]
+        if self.exemplarCount and self._exemplar_rows.get(label):
+            vecs.append(self._exemplars.embeddings[self._exemplar_rows[label]])
+        return np.concatenate(vecs)
 
     def work(self, input_items, output_items):
         in_mat = input_items[0]
         out_vec = output_items[0]
 
         if in_mat.shape[1] != self.embeddingLength:
+            self._metrics.count("errors")
             self._log.error(f"Embedding length incorrect: received {in_mat.shape[1]}, but expected {self.embeddingLength}.")
             return 0
-        
-        produced = 0
 
-        for i in range(in_mat.shape[0]):
-            embedding = np.squeeze(in_mat[i].astype(np.float32, copy=False))
+        if self._projection is not None:
+            with self._metrics.time("project"):
+                in_mat = self._projection.apply(in_mat)
+
+        if self.queryBackend == "CHROMA":
+            produced = self._work_chroma(in_mat, out_vec)
+        else:
+            produced = self._work_memory(in_mat, out_vec, input_items[1] if self.cfoInput else None)
+
+        if self._evicting:
+            self._evict()
+
+        self._metrics.count("frames", produced)
+        self._metrics.gauge("devices", self._n_devices)
+        if self._writer is not None:
+            self._metrics.gauge("persist_queue_depth", self._writer.depth)
+        self._metrics.maybe_publish(self, self._metrics_port)
+
+        return produced
+
+    def _work_memory(self, in_mat, out_vec, cfo=None):
+        embeddings = in_mat.astype(np.float32, copy=False)
+        queries = l2_normalize(embeddings)
+        n = queries.shape[0]
+        hot, hot_labels, hot_distances = self._hot_lookup(queries)
+        miss = np.flatnonzero(~hot)
+
+        # Frames with a valid CFO are only scored against devices of similar CFO
+        bounded = np.zeros(n, dtype=bool)
+        if cfo is not None:
+            bounded[miss] = np.isfinite(cfo[miss])
+            miss = miss[~bounded[miss]]
+
+        # One matrix multiply for the frames the hot set did not settle, against the
+        # gallery as it was at batch start. Prototypes (and CFOs) may change within the
+        # batch, so a few runners-up are kept for frames whose nearest devices were
+        # updated by earlier frames
+        k = 8 if self._prototypes or cfo is not None else 1
+        fallback = None
+        with self._metrics.time("query"):
+            candidates = self._search_candidates(queries, miss, k)
+            if bounded.any():
+                self._cfo_candidates(queries, cfo, np.flatnonzero(bounded), k, candidates)
+                # Frames with no match in their CFO window (likely new devices) will
+                # need the full search; run it for all of them at once
+                unmatched = bounded & (np.min([d[:, 0] for _, d, _ in candidates], axis=0) > self.threshold)
+                if unmatched.any():
+                    fallback = (self._search_candidates(queries, np.flatnonzero(unmatched), k), unmatched)
+
+        # Hot-set hits are taken as final: their only candidate is the hot device
+        labels, distances, exhaustive = candidates[0]
+        labels[hot, 0], distances[hot, 0], exhaustive[hot] = hot_labels[hot], hot_distances[hot], True
+
+        return self._assign_batch(embeddings, queries, candidates, out_vec, cfo, bounded, fallback)
+
+    def _search_candidates(self, queries, frames, k):
+        """(labels, distances, exhaustive) of the k nearest entries of each gallery, for `frames` only."""
+        n = queries.shape[0]
+        candidates = []
+        for gallery in ((self._gallery, self._exemplars) if self.exemplarCount else (self._gallery,)):
+            labels = np.full((n, k), -1, dtype=np.int64)
+            distances = np.full((n, k), np.inf, dtype=np.float32)
+            if frames.size:
+                rows, d = gallery.search(queries[frames], k=k)
+                labels[frames], distances[frames] = gallery.row_labels(rows), d
+            candidates.append((labels, distances, np.full(n, len(gallery) <= k)))
+        return candidates
+
+    def _cfo_candidates(self, queries, cfo, frames, k, candidates):
+        """
+        Fills in the candidates of `frames` from the devices within cfoWindow of each
+        frame's CFO. Frames are taken in order of CFO, and runs of frames whose CFOs
+        lie within one window of each other are scored together against the union of
+        their windows, masked to each frame's own.
+        """
+        frames = frames[np.argsort(cfo[frames], kind="stable")]
+        frame_cfo = cfo[frames].astype(np.float64)
+        lo, hi = self._cfo_index.bounds(frame_cfo, self.cfoWindow)
+        scored = 0
+        start = 0
+        while start < frames.size:
+            stop = int(np.searchsorted(frame_cfo, frame_cfo[start] + self.cfoWindow, side="right"))
+            group = frames[start:stop]
+            first, last = int(lo[start]), int(hi[stop - 1])
+            window = self._cfo_index.labels_between(first, last)
+            for gallery, (labels, distances, exhaustive) in zip((self._gallery, self._exemplars), candidates):
+                rows, owner = gallery.rows_of(window, return_owner=True)
+                own = (owner >= lo[start:stop, np.newaxis] - first) & (owner < hi[start:stop, np.newaxis] - first)
+                exhaustive[group] = own.sum(axis=1) <= k
+                if rows.size == 0:
+                    continue
+                sims = np.where(own, queries[group] @ gallery.embeddings[rows].T, -np.inf)
+                if rows.size > k:
+                    top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+                    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1, kind="stable"), axis=1)
+                else:
+                    top = np.argsort(-sims, axis=1, kind="stable")
+                best = np.take_along_axis(sims, top, axis=1)
+                found = np.isfinite(best)
+                labels[group, :top.shape[1]] = np.where(found, gallery.labels[rows[top]], -1)
+                distances[group, :top.shape[1]] = np.where(found, 1.0 - best, np.inf)
+                scored += int(own.sum())
+            start = stop
+        self._metrics.gauge("cfo_scored_fraction", scored / max(1, frames.size * (len(self._gallery) + len(self._exemplars))))
+
+    def _work_chroma(self, in_mat, out_vec):
+        embeddings = in_mat.astype(np.float32, copy=False)
+        queries = l2_normalize(embeddings)
+        n = embeddings.shape[0]
+        hot, hot_labels, hot_distances = self._hot_lookup(queries)
+        miss = np.flatnonzero(~hot)
+
+        # Enrollments and deletes still queued for Chroma; snapshot them before the query
+        # so that a record flushed in between is seen twice rather than not at all
+        pending_vecs, pending_labels, deleted = self._writer.pending()
+        pending_vecs = l2_normalize(pending_vecs)
+        self._chroma_pending = (pending_vecs, pending_labels, deleted)
+
+        # One query for the frames the hot set did not settle, against the collection
+        # as it was at batch start; stored embeddings are only needed to refill the hot set.
+        # Hits on devices whose delete is still queued are skipped, so enough results are
+        # asked for to get past all of them
+        include = ["distances", "metadatas", "embeddings"] if self.hotSize else ["distances", "metadatas"]
+        try:
+            with self._metrics.time("query"):
+                stored_count = self._db_collection.count() if miss.size else 0
+                k = min(stored_count, 1 + len(deleted))
+                query_res = self._query_chroma(embeddings[miss], k, include) if k else {}
+        except Exception as e:
+            self._metrics.count("errors")
+            self._log.error(f"Chroma query failed: {e}")
+            return 0
+
+        # Up to k Chroma results plus as many pending enrollments per frame, best first
+        n_pending = min(k if k else 1, pending_labels.shape[0])
+        width = max(1, k + n_pending)
+        best_labels = np.full((n, width), -1, dtype=np.int64)
+        best_distances = np.full((n, width), np.inf, dtype=np.float32)
+        self._chroma_vectors = {}
+        for m, i in enumerate(miss.tolist()):
+            found = [(d, label) for label, d in self._chroma_results(query_res, m) if str(label) not in deleted]
+            best_labels[i, :len(found)] = [label for _, label in found]
+            best_distances[i, :len(found)] = [d for d, _ in found]
+
+        if n_pending and miss.size:
+            sims = queries[miss] @ pending_vecs.T
+            top = np.argsort(-sims, axis=1, kind="stable")[:, :n_pending]
+            labels = np.concatenate([best_labels[miss], pending_labels[top]], axis=1)
+            distances = np.concatenate([best_distances[miss], 1.0 - np.take_along_axis(sims, top, axis=1)], axis=1)
+            order = np.argsort(distances, axis=1, kind="stable")[:, :width]
+            best_labels[miss] = np.take_along_axis(labels, order, axis=1)
+            best_distances[miss] = np.take_along_axis(distances, order, axis=1)
+            if self.hotSize:
+                self._chroma_vectors.update(zip(pending_labels[top[:, 0]].tolist(), pending_vecs[top[:, 0]]))
+
+        best_labels[hot, 0], best_distances[hot, 0] = hot_labels[hot], hot_distances[hot]
+
+        # Devices enrolled in this batch are neither in Chroma nor in the pending snapshot.
+        # The candidates cover every device unless Chroma holds more than was returned
+        exhaustive = np.full(n, k >= stored_count and n_pending == pending_labels.shape[0])
+        exhaustive[hot] = True
+        candidates = [(best_labels, best_distances, exhaustive)]
+        return self._assign_batch(embeddings, queries, candidates, out_vec)
 
+    def _query_chroma(self, embeddings, k, include):
+        return self._db_collection.query(query_embeddings=embeddings.tolist(), n_results=k, include=include)
+
+    def _chroma_results(self, query_res, m):
+        """(label, distance) of the results of query m, keeping stored vectors for the hot set."""
+        ids = (query_res.get("ids") or [])[m:m + 1]
+        if not ids:
+            return []
+        distances = query_res["distances"][m]
+        metadatas = (query_res.get("metadatas") or [[]] * (m + 1))[m] or [None] * len(ids[0])
+        stored = (query_res.get("embeddings") or [[]] * (m + 1))[m]
+        results = []
+        for j, _id in enumerate(ids[0]):
+            meta = metadatas[j]
+            label = int(meta["label"]) if isinstance(meta, dict) and "label" in meta else int(_id)
+            results.append((label, float(distances[j])))
+            if stored is not None and len(stored) > j:
+                self._chroma_vectors.setdefault(label, stored[j])
+        return results
+
+    def _chroma_untouched(self, query, touched):
+        """Nearest device in Chroma or pending for it that is neither deleted nor touched in this batch."""
+        pending_vecs, pending_labels, deleted = self._chroma_pending
+        best_label, best_distance = -1, float("inf")
+        stored_count = self._db_collection.count()
+        if stored_count:
+            k = min(stored_count, 1 + len(deleted) + touched.size)
             try:
-                query_res = self._db_collection.query(
-                    query_embeddings=[embedding.tolist()],
-                    n_results=1,
-                    include=["distances", "metadatas"]
-                )
+                res = self._query_chroma(query[np.newaxis], k, ["distances", "metadatas"])
             except Exception as e:
+                self._metrics.count("errors")
                 self._log.error(f"Chroma query failed: {e}")
-                return produced
-            
-            ids = (query_res.get("ids") or [[]])[0]
-            distances = (query_res.get("distances") or [[]])[0]
-            metadatas = (query_res.get("metadatas") or [[]])[0]
-
-            if len(ids) == 0:
-                # This means that there are no matches (likely empty DB); enrolling...
-                label = self._enroll(embedding)
-                out_vec[i] = np.int32(label)
-                produced += 1
+                res = {}
+            for label, distance in self._chroma_results(res, 0):
+                if str(label) not in deleted and label not in touched:
+                    best_label, best_distance = label, distance
+                    break
+        if pending_labels.shape[0]:
+            distances = 1.0 - pending_vecs @ query
+            distances[[label in touched for label in pending_labels.tolist()]] = np.inf
+            j = int(np.argmin(distances))
+            if distances[j] < best_distance:
+                best_label, best_distance = int(pending_labels[j]), float(distances[j])
+        return best_label, best_distance
 
-                self._log.info(f"NEW DEVICE: ID {label}")
+    def _hot_lookup(self, queries):
+        """
+        Scores the batch against the recently matched devices only. Frames whose best
+        distance is within hotMargin * cosineThreshold are settled by the hot set and
+        skip the full index; returns (hit mask, hot labels, hot distances).
+        """
+        n = queries.shape[0]
+        if not self.hotSize:
+            return np.zeros(n, dtype=bool), np.full(n, -1, dtype=np.int64), np.full(n, np.inf, dtype=np.float32)
 
-                continue
+        if self._hot:
+            with self._metrics.time("hot"):
+                labels = np.fromiter(self._hot.keys(), dtype=np.int64, count=len(self._hot))
+                sims = queries @ np.stack(list(self._hot.values())).T
+                j = np.argmax(sims, axis=1)
+                labels, distances = labels[j], 1.0 - sims[np.arange(n), j]
+                hit = distances <= self.hotMargin * self.threshold
+        else:
+            hit = np.zeros(n, dtype=bool)
+            labels, distances = np.full(n, -1, dtype=np.int64), np.full(n, np.inf, dtype=np.float32)
 
-            best_id = ids[0]
-            best_distance = float(distances[0])
+        self._hot_queries += n
+        self._hot_hits += int(hit.sum())
+        self._metrics.count("hot_queries", n)
+        self._metrics.count("hot_hits", int(hit.sum()))
+        self._metrics.gauge("hot_hit_rate", self._hot_hits / self._hot_queries)
+        return hit, labels, distances
 
-            # If device cos distance <= threshold -- this is a known device, returning ID
-            if best_distance <= self.threshold:
-                if isinstance(metadatas, dict) and "label" in metadatas:
-                    label = int(metadatas["label"])
+    def _heat(self, label, query):
+        """Moves a device that was just matched or enrolled to the front of the hot set."""
+        if self.queryBackend == "MEMORY":
+            vec = self._gallery.embeddings[self._gallery.row_of(label)].copy()
+        elif label in self._hot:
+            vec = self._hot[label]
+        else:
+            vec = l2_normalize(self._chroma_vectors.get(label, query))
+        self._hot[label] = vec
+        self._hot.move_to_end(label)
+        if len(self._hot) > self.hotSize:
+            self._hot.popitem(last=False)
+
+    def _assign_batch(self, embeddings, queries, candidates, out_vec, cfo=None, bounded=None, fallback=None):
+        """
+        Turns the batch query results into labels, enrolling unknown devices.
+
+        `candidates` holds one (labels, distances, exhaustive) triple per searched
+        gallery: the nearest entries of each frame as of batch start, best first, and
+        whether they cover every entry that could match the frame.
+        Devices enrolled or updated by earlier frames of the batch ("touched") are
+        skipped there and scored against their current vectors instead, so several
+        frames of one new device share a single label and the result is exactly that
+        of frame-by-frame processing.
+
+        With a CFO input, `bounded` frames were only searched within cfoWindow of their
+        CFO; when nothing there matches, they fall back to a search of every device,
+        prefetched in `fallback` (candidates, frames) for the frames expected to need
+        it. Devices whose CFO moves count as touched.
+        """
+        touched = _TouchedDevices(self._dim)
+
+        for i in range(embeddings.shape[0]):
+            frame_cfo = float(cfo[i]) if cfo is not None else float("nan")
+            in_window = bounded is not None and bounded[i]
+            label, best_distance = self._best_untouched(i, queries[i], candidates, touched, frame_cfo if in_window else None)
+
+            if touched:
+                t_label, t_distance = touched.nearest(queries[i], frame_cfo if in_window else None, self.cfoWindow)
+                if t_distance < best_distance:
+                    label, best_distance = t_label, t_distance
+
+            if in_window and not (label >= 0 and best_distance <= self.threshold):
+                # Nothing within the CFO window matched; search every device
+                self._metrics.count("cfo_fallbacks")
+                if fallback is not None and fallback[1][i]:
+                    label, best_distance = self._best_untouched(i, queries[i], fallback[0], touched)
                 else:
-                    label = int(best_id)
-                self._update_label_stats(label)
+                    label, best_distance = self._exact_untouched(queries[i], touched)
+                if touched:
+                    t_label, t_distance = touched.nearest(queries[i])
+                    if t_distance < best_distance:
+                        label, best_distance = t_label, t_distance
+
+            # If device cos distance <= threshold -- this is a known device, returning ID
+            if label >= 0 and best_distance <= self.threshold:
+                count = self._update_label_stats(label)
+                self._metrics.count("matched")
                 out_vec[i] = np.int32(label)
 
+                if self._prototypes:
+                    self._observe(label, queries[i], count)
+                if np.isfinite(frame_cfo):
+                    self._cfo_index.update(label, frame_cfo, self.cfoAlpha)
+                if self._prototypes or np.isfinite(frame_cfo):
+                    touched.set(label, self._label_vectors(label), self._cfo_index.get(label))
+                if self.hotSize:
+                    self._heat(label, queries[i])
+
                 self._log.info(f"KNOWN DEVICE: ID {label}")
-            else: 
+            else:
                 # Otherwise -- unknown; enrolling
-                label = self._enroll(embedding)
+                label = self._enroll(embeddings[i])
                 out_vec[i] = np.int32(label)
+                if np.isfinite(frame_cfo):
+                    self._cfo_index.update(label, frame_cfo)
+
+                vecs = self._label_vectors(label) if self.queryBackend == "MEMORY" else queries[i:i + 1]
+                touched.set(label, vecs, self._cfo_index.get(label))
+                if self.hotSize:
+                    self._heat(label, queries[i])
+
+                # The maxDevices cap holds at every enrollment, not only between batches
+                if self.maxDevices and self._n_devices > self.maxDevices:
+                    for victim in self._evict(expire=False):
+                        touched.drop(victim)
 
                 self._log.info(f"NEW DEVICE: ID {label}")
 
-            produced += 1
+        return embeddings.shape[0]
+
+    def _best_untouched(self, i, query, candidates, touched, frame_cfo=None):
+        best_label, best_distance = -1, float("inf")
+        for labels, distances, exhaustive in candidates:
+            for label, distance in zip(labels[i].tolist(), distances[i].tolist()):
+                if label in touched:
+                    continue
+                if label >= 0 and distance < best_distance:
+                    best_label, best_distance = label, distance
+                break
+            else:
+                label = -1
+            # Every runner-up was touched, or the frame's only (hot) candidate was evicted
+            # since the search; rare enough to fall back to a full scan
+            if label < 0 and labels[i, 0] >= 0 and (not exhaustive[i] or touched.evicted(int(labels[i, 0]))):
+                window = None if frame_cfo is None else self._cfo_index.window(frame_cfo, self.cfoWindow)
+                return self._exact_untouched(query, touched, window)
+        return best_label, best_distance
 
-        return produced
\ No newline at end of file
+    def _exact_untouched(self, query, touched, window=None):
+        if self.queryBackend == "CHROMA":
+            return self._chroma_untouched(query, touched)
+        best_label, best_distance = -1, float("inf")
+        exclude = np.fromiter(touched.keys(), dtype=np.int64, count=len(touched))
+        for gallery in (self._gallery, self._exemplars):
+            if len(gallery) == 0:
+                continue
+            distances = 1.0 - gallery.embeddings @ query
+            distances[np.isin(gallery.labels, exclude)] = np.inf
+            if window is not None:
+                distances[~np.isin(gallery.labels, window)] = np.inf
+            j = int(np.argmin(distances))
+            if distances[j] < best_distance:
+                best_label, best_distance = int(gallery.labels[j]), float(distances[j])
+        return best_label, best_distance